@@ -0,0 +1,5 @@
+"""
+Throughput and latency benchmarks for the messaging patterns in this repo.
+
+Run with: python -m bench --help
+"""
@@ -0,0 +1,148 @@
+import argparse
+import collections
+import itertools
+import json
+import logging
+import subprocess
+import time
+import zmq
+
+from bench.patterns import PATTERNS
+from bench.tuning import AFFINITY_MODES, ContextConfig, build_context
+
+
+logging.basicConfig(level=logging.INFO, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
+log_bench = logging.getLogger(name="BENCH")
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def _str_list(value):
+    return value.split(",")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench",
+                                     description="Throughput and latency of the zmq patterns in this repo. "
+                                                 "List options take comma separated values and every combination "
+                                                 "is run.")
+    parser.add_argument("--pattern", type=_str_list, default=sorted(PATTERNS),
+                        help="patterns to run (default: %(default)s)")
+    parser.add_argument("--transport", type=_str_list, default=["tcp"], help="inproc, ipc and/or tcp")
+    parser.add_argument("--size", type=_int_list, default=[64], help="bytes per payload frame")
+    parser.add_argument("--frames", type=_int_list, default=[2],
+                        help="frames per message, the first one always carries the timestamp")
+    parser.add_argument("--peers", type=_int_list, default=[1], help="clients, subscribers or senders")
+    parser.add_argument("--hwm", type=_int_list, default=[1000], help="SNDHWM/RCVHWM of every socket")
+    parser.add_argument("--count", type=int, default=10000, help="messages per peer")
+    parser.add_argument("--workers", type=int, default=2, help="workers behind the proxy")
+    parser.add_argument("--io-threads", type=_int_list, help="I/O threads of the context (default: from --config)")
+    parser.add_argument("--affinity", type=_str_list,
+                        help="socket affinity: none or spread over the I/O threads (default: from --config)")
+    parser.add_argument("--max-sockets", type=_int_list, help="MAX_SOCKETS of the context (default: from --config)")
+    parser.add_argument("--config", help="context config file (JSON, see bench/tuning.py) the runs start from")
+    parser.add_argument("--recommend", metavar="FILE",
+                        help="write the io_threads/affinity/max_sockets combination with the best throughput as "
+                             "config file")
+    parser.add_argument("--port", type=int, default=5555, help="first tcp port, some patterns use port+1 too")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    options = parser.parse_args(argv)
+    unknown = set(options.pattern) - set(PATTERNS)
+    if unknown:
+        parser.error("unknown pattern(s): %s" % ", ".join(sorted(unknown)))
+    options.context = ContextConfig.load(options.config) if options.config else ContextConfig()
+    options.io_threads = options.io_threads or [options.context.io_threads]
+    options.max_sockets = options.max_sockets or [options.context.max_sockets]
+    affinity = options.context.affinity
+    options.affinity = options.affinity or [tuple(affinity) if isinstance(affinity, list) else affinity]
+    unknown = set(mode for mode in options.affinity if not isinstance(mode, tuple)) - set(AFFINITY_MODES)
+    if unknown:
+        parser.error("unknown affinity mode(s): %s" % ", ".join(sorted(unknown)))
+    return options
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+WORKLOAD = ("pattern", "transport", "size", "frames", "peers", "hwm")
+
+
+def recommend(runs):
+    """
+    The (io_threads, affinity, max_sockets) combination with the best throughput over all workloads. Every run is scored
+    relative to the best run of the same workload, so a fast pattern doesn't outweigh the others.
+    """
+    best = collections.defaultdict(float)
+    for result in runs:
+        workload = tuple(result[key] for key in WORKLOAD)
+        best[workload] = max(best[workload], result["msgs_per_s"])
+    scores = collections.defaultdict(list)
+    for result in runs:
+        workload = tuple(result[key] for key in WORKLOAD)
+        if best[workload] > 0:
+            combination = (result["io_threads"], result["affinity"], result["max_sockets"])
+            scores[combination].append(result["msgs_per_s"] / best[workload])
+    if not scores:
+        return None
+    return max(scores, key=lambda combination: sum(scores[combination]) / len(scores[combination]))
+
+
+def run(options):
+    runs = []
+    for io_threads, affinity, max_sockets, pattern, transport, size, frames, peers, hwm in itertools.product(
+            options.io_threads, options.affinity, options.max_sockets, options.pattern, options.transport,
+            options.size, options.frames, options.peers, options.hwm):
+        params = argparse.Namespace(**vars(options))
+        params.transport, params.size, params.frames, params.peers, params.hwm = transport, size, frames, peers, hwm
+        config = ContextConfig(**options.context.to_dict())
+        config.io_threads, config.affinity, config.max_sockets = io_threads, affinity, max_sockets
+        context = build_context(config)
+        try:
+            result = PATTERNS[pattern](context, params).to_dict()
+        finally:
+            context.destroy(linger=0)
+        result.update(pattern=pattern, transport=transport, size=size, frames=frames, peers=peers, hwm=hwm,
+                      count=options.count, io_threads=io_threads, affinity=affinity, max_sockets=max_sockets)
+        latency = result["latency_us"]
+        log_bench.info("%s/%s size=%d frames=%d peers=%d hwm=%d io_threads=%d affinity=%s max_sockets=%s: "
+                       "%.0f msgs/s, %.1f MB/s, p50=%sus p99=%sus p999=%sus, lost=%d", pattern, transport, size, frames,
+                       peers, hwm, io_threads, affinity, max_sockets, result["msgs_per_s"], result["mb_per_s"],
+                       latency["p50"], latency["p99"], latency["p999"], result["lost"])
+        runs.append(result)
+    return {
+        "commit": _git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "libzmq": zmq.zmq_version(),
+        "pyzmq": zmq.__version__,
+        "context": options.context.to_dict(),
+        "runs": runs,
+    }
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = run(options)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        log_bench.info("Results written to %s", options.output)
+    if options.recommend:
+        best = recommend(report["runs"])
+        if best is None:
+            log_bench.warning("No throughput measured, nothing to recommend")
+            return
+        config = ContextConfig(**options.context.to_dict())
+        config.io_threads, config.affinity, config.max_sockets = best
+        config.save(options.recommend)
+        log_bench.info("Recommended io_threads=%d affinity=%s max_sockets=%s, written to %s", best[0], best[1], best[2],
+                       options.recommend)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import collections
+import struct
+import threading
+import timeit
+import zmq
+
+from socket_features.histogram import Histogram
+
+
+clock = timeit.default_timer
+
+TIMESTAMP = struct.Struct("!d")
+END_MSG = "%END%"
+READY = "READY"
+
+
+def endpoint(transport, name, port):
+    if transport == "inproc":
+        return "inproc://bench-%s" % name
+    if transport == "ipc":
+        return "ipc:///tmp/bench-%s" % name
+    return "tcp://127.0.0.1:%d" % port
+
+
+def make_message(size, frames):
+    """Timestamp frame followed by frames-1 payload frames of size bytes each"""
+    return [None] + ["x" * size] * (frames - 1)
+
+
+def stamp(message):
+    message[0] = TIMESTAMP.pack(clock())
+    return message
+
+
+def elapsed_us(message):
+    return (clock() - TIMESTAMP.unpack(message[0])[0]) * 1e6
+
+
+class Result(object):
+    def __init__(self):
+        self.histogram = Histogram()
+        self.msgs = 0
+        self.bytes = 0
+        self.lost = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, histogram, msgs, n_bytes):
+        with self._lock:
+            self.histogram.merge(histogram)
+            self.msgs += msgs
+            self.bytes += n_bytes
+
+    def to_dict(self):
+        elapsed = self.elapsed or float("nan")
+        return {
+            "msgs": self.msgs,
+            "lost": self.lost,
+            "elapsed_s": self.elapsed,
+            "msgs_per_s": self.msgs / elapsed,
+            "mb_per_s": self.bytes / elapsed / 1e6,
+            "latency_us": self.histogram.summary(),
+        }
+
+
+def _socket(context, sock_type, hwm):
+    sock = context.socket(sock_type)
+    sock.set_hwm(hwm)
+    sock.linger = 0
+    return sock
+
+
+def _run_threads(targets):
+    threads = [threading.Thread(target=target, args=args) for target, args in targets]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads
+
+
+def reqrep(context, options):
+    """REQ clients against one REP server (context/context.py), latency is the full round-trip"""
+    url = endpoint(options.transport, "reqrep", options.port)
+    result = Result()
+    server = _socket(context, zmq.REP, options.hwm)
+    server.bind(url)
+
+    def serve(total):
+        for _ in range(total):
+            server.send_multipart(server.recv_multipart(copy=False), copy=False)
+        server.close()
+
+    def client():
+        sock = _socket(context, zmq.REQ, options.hwm)
+        sock.connect(url)
+        histogram = Histogram()
+        message = make_message(options.size, options.frames)
+        for _ in range(options.count):
+            sock.send_multipart(stamp(message))
+            histogram.record(elapsed_us(sock.recv_multipart()))
+        sock.close()
+        result.add(histogram, options.count, options.count * options.size * (options.frames - 1))
+
+    start = clock()
+    clients = _run_threads([(client, ())] * options.peers)
+    server_thread = _run_threads([(serve, (options.count * options.peers,))])[0]
+    for thread in clients:
+        thread.join()
+    server_thread.join()
+    result.elapsed = clock() - start
+    return result
+
+
+def pubsub(context, options):
+    """
+    One PUB to several SUBs (socket_types/pub-sub.py), latency is one-way publish to receive. The clock stops at the
+    last message received: END_MSG may be dropped at the HWM and the subscriber then waits out its poll timeout.
+    """
+    url = endpoint(options.transport, "pubsub", options.port)
+    sync_url = endpoint(options.transport, "pubsub-sync", options.port + 1)
+    result = Result()
+    last_received = []
+    publisher = _socket(context, zmq.PUB, options.hwm)
+    publisher.bind(url)
+    sync = _socket(context, zmq.PULL, options.hwm)
+    sync.bind(sync_url)
+
+    def subscriber():
+        sock = _socket(context, zmq.SUB, options.hwm)
+        sock.setsockopt(zmq.SUBSCRIBE, "")
+        sock.connect(url)
+        ready = _socket(context, zmq.PUSH, options.hwm)
+        ready.connect(sync_url)
+        while sock.recv_multipart()[0] != "W":  # wait for a warm-up message so no data message is lost
+            pass
+        ready.send("ready")
+        histogram = Histogram()
+        received = 0
+        last = None
+        while sock.poll(1000):
+            message = sock.recv_multipart()
+            if message[0] == "W":
+                continue
+            if message[0] == END_MSG:
+                break
+            last = clock()
+            histogram.record(elapsed_us(message))
+            received += 1
+        if last is not None:
+            last_received.append(last)
+        ready.close()
+        sock.close()
+        result.add(histogram, received, received * options.size * (options.frames - 1))
+
+    subscribers = _run_threads([(subscriber, ())] * options.peers)
+    ready = 0
+    while ready < options.peers:  # keep warming up until every subscriber is connected (slow joiner)
+        publisher.send_multipart(["W"])
+        while sync.poll(10):
+            sync.recv()
+            ready += 1
+
+    message = make_message(options.size, options.frames)
+    start = clock()
+    for _ in range(options.count):
+        publisher.send_multipart(stamp(message))
+    publisher.send_multipart([END_MSG])
+    for thread in subscribers:
+        thread.join()
+    result.elapsed = max(last_received) - start if last_received else 0.0
+    result.lost = options.count * options.peers - result.msgs
+    publisher.close()
+    sync.close()
+    return result
+
+
+def proxy(context, options):
+    """
+    REQ clients -> ROUTER -> load-balancing broker -> ROUTER -> DEALER workers, the broker of
+    socket_features/multithreaded_proxy.py with the worker sleep removed; latency is the full round-trip
+    """
+    client_url = endpoint(options.transport, "proxy-clients", options.port)
+    worker_url = endpoint(options.transport, "proxy-workers", options.port + 1)
+    result = Result()
+    frontend = _socket(context, zmq.ROUTER, options.hwm)
+    frontend.bind(client_url)
+    backend = _socket(context, zmq.ROUTER, options.hwm)
+    backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+    backend.bind(worker_url)
+
+    def broker(stop):
+        ready = collections.deque()
+        poll_workers = zmq.Poller()
+        poll_workers.register(backend, zmq.POLLIN)
+        poll_both = zmq.Poller()
+        poll_both.register(backend, zmq.POLLIN)
+        poll_both.register(frontend, zmq.POLLIN)
+        while not stop.is_set():
+            sockets = dict((poll_both if ready else poll_workers).poll(100))
+            if backend in sockets:
+                frames = backend.recv_multipart(copy=False)
+                ready.append(frames[0].bytes)
+                if len(frames) > 2:  # not just READY: [worker_addr, client_addr, "", reply...]
+                    frontend.send_multipart(frames[1:], copy=False)
+            if ready and frontend in sockets:
+                backend.send_multipart([ready.popleft()] + frontend.recv_multipart(copy=False), copy=False)
+
+    def worker(stop):
+        sock = _socket(context, zmq.DEALER, options.hwm)
+        sock.connect(worker_url)
+        sock.send(READY)  # credit 1, the reply gives it back
+        while not stop.is_set():
+            if sock.poll(100):
+                sock.send_multipart(sock.recv_multipart(copy=False), copy=False)
+        sock.close()
+
+    def client():
+        sock = _socket(context, zmq.REQ, options.hwm)
+        sock.connect(client_url)
+        histogram = Histogram()
+        message = make_message(options.size, options.frames)
+        for _ in range(options.count):
+            sock.send_multipart(stamp(message))
+            histogram.record(elapsed_us(sock.recv_multipart()))
+        sock.close()
+        result.add(histogram, options.count, options.count * options.size * (options.frames - 1))
+
+    stop = threading.Event()
+    broker_thread = _run_threads([(broker, (stop,))])[0]
+    workers = _run_threads([(worker, (stop,))] * options.workers)
+    start = clock()
+    clients = _run_threads([(client, ())] * options.peers)
+    for thread in clients:
+        thread.join()
+    result.elapsed = clock() - start
+    stop.set()
+    for thread in workers + [broker_thread]:
+        thread.join()
+    frontend.close()
+    backend.close()
+    return result
+
+
+def multipart(context, options):
+    """One-way stream of multipart messages (messages/multipart.py) over PUSH/PULL, peers are parallel streams"""
+    url = endpoint(options.transport, "multipart", options.port)
+    result = Result()
+    receiver = _socket(context, zmq.PULL, options.hwm)
+    receiver.bind(url)
+
+    def sender():
+        sock = _socket(context, zmq.PUSH, options.hwm)
+        sock.connect(url)
+        message = make_message(options.size, options.frames)
+        for _ in range(options.count):
+            sock.send_multipart(stamp(message))
+        sock.send_multipart([END_MSG])
+        sock.close(linger=-1)
+
+    start = clock()
+    senders = _run_threads([(sender, ())] * options.peers)
+    histogram = Histogram()
+    received = 0
+    finished = 0
+    while finished < options.peers:
+        message = receiver.recv_multipart()
+        if message[0] == END_MSG:
+            finished += 1
+            continue
+        histogram.record(elapsed_us(message))
+        received += 1
+    result.elapsed = clock() - start
+    for thread in senders:
+        thread.join()
+    receiver.close()
+    result.add(histogram, received, received * options.size * (options.frames - 1))
+    return result
+
+
+PATTERNS = {
+    "reqrep": reqrep,
+    "pubsub": pubsub,
+    "proxy": proxy,
+    "multipart": multipart,
+}
@@ -0,0 +1,96 @@
+import itertools
+import json
+import logging
+import os
+import zmq
+
+
+log_tuning = logging.getLogger(name="TUNING")
+
+AFFINITY_MODES = ("none", "spread")
+
+
+class ContextConfig(object):
+    """
+    How to build a context, usually loaded from a JSON file:
+
+        {"io_threads": 4, "max_sockets": 4096, "affinity": "spread", "io_cpus": [0, 1, 2, 3], "app_cpus": [4, 5]}
+
+    - io_threads: I/O threads of the context (zmq.IO_THREADS), the default of 1 is a bottleneck for many peers
+    - max_sockets: zmq.MAX_SOCKETS, None keeps the libzmq default (1023)
+    - affinity: zmq.AFFINITY of every new socket: "none" lets libzmq pick the I/O thread, "spread" assigns the
+      sockets round-robin to the I/O threads, a list of bitmasks is used round-robin as given
+    - io_cpus: CPUs the I/O threads are pinned to (ZMQ_THREAD_AFFINITY_CPU_ADD, libzmq 4.3)
+    - app_cpus: CPUs the creating thread is pinned to, threads it starts afterwards inherit that (Linux, Python 3.3)
+    """
+
+    def __init__(self, io_threads=1, max_sockets=None, affinity="none", io_cpus=(), app_cpus=()):
+        if affinity not in AFFINITY_MODES and not isinstance(affinity, (list, tuple)):
+            raise ValueError("affinity must be one of %s or a list of bitmasks" % ", ".join(AFFINITY_MODES))
+        self.io_threads = io_threads
+        self.max_sockets = max_sockets
+        self.affinity = affinity
+        self.io_cpus = list(io_cpus)
+        self.app_cpus = list(app_cpus)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as config_file:
+            return cls(**json.load(config_file))
+
+    def save(self, path):
+        with open(path, "w") as config_file:
+            json.dump(self.to_dict(), config_file, indent=2, sort_keys=True)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def affinity_mask(self, index):
+        """AFFINITY bitmask for the index-th socket of the context, 0 means any I/O thread"""
+        if self.affinity == "none":
+            return 0
+        if self.affinity == "spread":
+            return 1 << (index % self.io_threads)
+        return self.affinity[index % len(self.affinity)]
+
+
+class TunedContext(zmq.Context):
+    """A Context applying the AFFINITY of its ContextConfig to every socket it creates, see build_context()"""
+
+    config = None  # pyzmq only allows setting attributes defined on the class
+    _created = None
+
+    def socket(self, socket_type, **kwargs):
+        sock = super(TunedContext, self).socket(socket_type, **kwargs)
+        mask = self.config.affinity_mask(next(self._created))
+        if mask:
+            sock.setsockopt(zmq.AFFINITY, mask)
+        return sock
+
+
+def build_context(config=None):
+    """
+    Create a context from a ContextConfig (or the path of a config file). Options the installed libzmq or Python
+    don't support are skipped with a warning rather than failing, so one config file works on every box.
+    """
+    if config is None:
+        config = ContextConfig()
+    elif not isinstance(config, ContextConfig):
+        config = ContextConfig.load(config)
+    context = TunedContext(io_threads=config.io_threads)
+    context.config = config
+    context._created = itertools.count()
+    if config.max_sockets:
+        context.set(zmq.MAX_SOCKETS, config.max_sockets)
+    if config.io_cpus:
+        if hasattr(zmq, "THREAD_AFFINITY_CPU_ADD"):
+            for cpu in config.io_cpus:  # must happen before the first socket starts the I/O threads
+                context.set(zmq.THREAD_AFFINITY_CPU_ADD, cpu)
+        else:
+            log_tuning.warning("This libzmq/pyzmq can't pin I/O threads, io_cpus ignored")
+    if config.app_cpus:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, config.app_cpus)
+        else:
+            log_tuning.warning("This Python can't pin threads, app_cpus ignored")
+    return context
@@ -1,6 +1,10 @@
+import collections
 import logging
+import struct
 import zmq
 
+from serializers import get_codec
+
 
 logging.basicConfig(level=logging.INFO, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
 log_server = logging.getLogger(name="SERVER")
@@ -19,7 +23,16 @@ def create_client(context, address):
     return client
 
 
-def send_message(participant, message):
+def send_message(participant, message, codec=None, copy_threshold=1024):
+    """
+    With a codec (see serializers.py) any object can be sent: it is encoded into frames and frames bigger than
+    copy_threshold go out with copy=False, so large buffers are handed to zmq without copying.
+    """
+    if codec is not None:
+        frames = codec.encode(message)
+        for frame in frames[:-1]:
+            participant.send(frame, zmq.SNDMORE, copy=len(frame) <= copy_threshold)
+        return participant.send(frames[-1], copy=len(frames[-1]) <= copy_threshold)
     if isinstance(message, list):
         participant.send_multipart(message)  # internally the list is iterated as in the code commented below
         #for part in message[:-1]:
@@ -29,13 +42,17 @@ def send_message(participant, message):
         return participant.send(message)
 
 
-def receive_message(participant):
+def receive_message(participant, codec=None):
     """
     Multipart message can only be received with recv_multipart().
     Otherwise only the first part if returned by recv().
 
     recv_multipart() can be used to get single-part message but it returns a list of one item instead of a the message body
+
+    With a codec the frames are received with copy=False and decoded from views on the zmq frames.
     """
+    if codec is not None:
+        return codec.decode([frame.buffer for frame in participant.recv_multipart(copy=False)])
     msg = participant.recv_multipart()
     if isinstance(msg, list) and len(msg) == 1:
         return msg[0]
@@ -43,6 +60,97 @@ def receive_message(participant):
         return msg
 
 
+class BufferPool(object):
+    """
+    Reusable bytearrays for coalescing the small parts of a batch.
+
+    The coalesced frame is sent with copy=True (it's small, libzmq takes its own copy right away) so the buffer can go
+    back to the pool as soon as send_multipart() returns.
+    """
+
+    def __init__(self, buffer_size=64 * 1024):
+        self.buffer_size = buffer_size
+        self._free = collections.deque()
+
+    def get(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.buffer_size)
+
+    def put(self, buf):
+        self._free.append(buf)
+
+
+_default_pool = BufferPool()
+
+
+def send_batch(participant, messages, pool=None, copy_threshold=1024):
+    """
+    Send N multipart messages as one zmq message.
+
+    Frame 0 is an index of int32 values: the number of messages, then for every message its number of parts followed
+    by the part lengths. Parts up to copy_threshold bytes are packed into frame 1 (a pooled buffer), a length of -1
+    means the part is too big for that and follows as its own frame, sent with copy=False so large payloads are never
+    copied. Only receive_batch() understands the result.
+    """
+    pool = pool or _default_pool
+    buf = pool.get()
+    view = memoryview(buf)
+    used = 0
+    index = [len(messages)]
+    large = []
+    try:
+        for message in messages:
+            index.append(len(message))
+            for part in message:
+                size = len(part)
+                if size <= copy_threshold and used + size <= len(buf):
+                    view[used:used + size] = part
+                    used += size
+                    index.append(size)
+                else:
+                    large.append(part)
+                    index.append(-1)
+        header = struct.pack("!%di" % len(index), *index)
+        participant.send(header, zmq.SNDMORE)
+        participant.send(view[:used], zmq.SNDMORE if large else 0, copy=True)
+        if large:
+            participant.send_multipart(large, copy=False)
+    finally:
+        pool.put(buf)
+
+
+def receive_batch(participant):
+    """
+    Receive one batch sent with send_batch() and return it as a list of messages.
+
+    The frames are received with copy=False and every part is a memoryview into the zmq frames: nothing is copied
+    and no bytes object is created per part. The views keep the frames alive; call tobytes() to get a copy.
+    """
+    frames = participant.recv_multipart(copy=False)
+    header = frames[0].bytes
+    index = struct.unpack("!%di" % (len(header) // 4), header)
+    packed = frames[1].buffer
+    large = iter(frames[2:])
+    offset = 0
+    pos = 1
+    messages = []
+    for _ in range(index[0]):
+        n_parts = index[pos]
+        pos += 1
+        message = []
+        for size in index[pos:pos + n_parts]:
+            if size < 0:
+                message.append(next(large).buffer)
+            else:
+                message.append(packed[offset:offset + size])
+                offset += size
+        pos += n_parts
+        messages.append(message)
+    return messages
+
+
 def clean_up(context, *sockets):
     for sock in sockets:
         sock.close()
@@ -60,6 +168,19 @@ def main():
     log_client.info("Sent message: %s", msg)
     msg = receive_message(server)
     log_server.info("Received: %s", msg)
+    send_message(server, 'ack')
+    receive_message(client)
+
+    batch = [['A', str(i)] for i in range(100)] + [['big', 'x' * 100000]]
+    send_batch(client, batch)
+    log_client.info("Sent batch of %d messages", len(batch))
+    msgs = receive_batch(server)
+    log_server.info("Received batch of %d messages, first: %s", len(msgs), [part.tobytes() for part in msgs[0]])
+
+    codec = get_codec("pickle")
+    send_message(server, {"received": len(msgs)}, codec=codec)
+    reply = receive_message(client, codec=codec)
+    log_client.info("Received with %s codec: %d messages acknowledged", codec.name, reply["received"])
 
     clean_up(context, server, client)
 
@@ -0,0 +1,93 @@
+"""
+Codecs turning Python objects into message frames and back, for send_message()/receive_message() in multipart.py.
+
+A codec has a name and two methods: encode(obj) returns a list of frames (bytes or any buffer), decode(frames)
+takes the received frames as memoryviews. Big frames are handed to zmq with copy=False by multipart.py, so a codec
+that returns buffers of the object itself (pickle protocol 5 out-of-band buffers, NumPy arrays) ships the payload
+without copying it. msgpack and NumPy are optional: their codecs are only registered when the package is installed.
+"""
+import json
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _as_bytes(frame):
+    return frame.tobytes() if isinstance(frame, memoryview) else bytes(frame)
+
+
+class PickleCodec(object):
+    """
+    Pickle with the highest protocol available. With protocol 5 (Python 3.8+) objects supporting out-of-band buffers
+    (NumPy arrays, pickle.PickleBuffer) are not copied into the pickle but travel as extra frames, and are unpickled
+    from the received frames directly. Older protocols put everything in one frame.
+    """
+
+    name = "pickle"
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def encode(self, obj):
+        if self.protocol < 5:
+            return [pickle.dumps(obj, self.protocol)]
+        buffers = []
+        data = pickle.dumps(obj, self.protocol, buffer_callback=buffers.append)
+        return [data] + [buf.raw() for buf in buffers]
+
+    def decode(self, frames):
+        if self.protocol < 5:
+            return pickle.loads(_as_bytes(frames[0]))
+        return pickle.loads(frames[0], buffers=frames[1:])
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+
+    def encode(self, obj):
+        return [msgpack.packb(obj, use_bin_type=True)]
+
+    def decode(self, frames):
+        return msgpack.unpackb(_as_bytes(frames[0]))
+
+
+class NumpyCodec(object):
+    """
+    One array as two frames: a small JSON header with dtype and shape, then the raw array memory. The array is sent
+    from its own buffer (only made contiguous if it isn't) and the received array is a read-only view on the zmq frame.
+    """
+
+    name = "numpy"
+
+    def encode(self, array):
+        array = numpy.ascontiguousarray(array)
+        header = json.dumps({"dtype": array.dtype.str, "shape": array.shape})
+        return [header.encode("ascii"), array.reshape(-1).view(numpy.uint8)]
+
+    def decode(self, frames):
+        header = json.loads(_as_bytes(frames[0]).decode("ascii"))
+        return numpy.frombuffer(frames[1], dtype=header["dtype"]).reshape(header["shape"])
+
+
+CODECS = dict((codec.name, codec) for codec in [PickleCodec()] +
+              ([MsgpackCodec()] if msgpack is not None else []) +
+              ([NumpyCodec()] if numpy is not None else []))
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("codec %r is not available, installed codecs: %s" % (name, ", ".join(sorted(CODECS))))
@@ -0,0 +1,6 @@
+"""
+Socket features and the helpers built on them (registry, telemetry, HWM controller, tracing, histogram...).
+
+The scripts run from this directory; scripts of other directories import the helpers as socket_features.<module>
+and run as modules from the repo root.
+"""
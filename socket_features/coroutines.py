@@ -0,0 +1,348 @@
+import collections
+import heapq
+import itertools
+import logging
+import time
+import zmq
+
+from reactor import Reactor
+
+
+logging.basicConfig(level=logging.INFO, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
+log_runtime = logging.getLogger(name="RUNTIME")
+log_worker = logging.getLogger(name="WORKER")
+log_client = logging.getLogger(name="CLIENT")
+log_sub = logging.getLogger(name="SUBSCRIBER")
+
+
+class _Waiter(object):
+    """A suspended coroutine, resumed by whatever comes first (message, timeout, permit)"""
+
+    __slots__ = ("coroutine", "done")
+
+    def __init__(self, coroutine):
+        self.coroutine = coroutine
+        self.done = False
+
+
+class Semaphore(object):
+    """Bounds how many coroutines are past `yield semaphore.acquire()` at the same time, until they release()"""
+
+    def __init__(self, runtime, value):
+        self._runtime = runtime
+        self.value = value
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        def wait(coroutine):
+            if self.value > 0:
+                self.value -= 1
+                self._runtime._ready.append((coroutine, None))
+            else:
+                self._waiters.append(coroutine)
+        return wait
+
+    def release(self):
+        if self._waiters:
+            self._runtime._ready.append((self._waiters.popleft(), None))
+        else:
+            self.value += 1
+
+
+class Runtime(object):
+    """
+    Runs thousands of logical peers as generator coroutines on one thread, on top of the epoll Reactor.
+
+    A coroutine suspends by yielding what it waits for and is resumed with the result:
+
+        frames = yield runtime.recv(sock, timeout=2.5)  # None on timeout
+        yield runtime.sleep(0.1)
+        yield semaphore.acquire()
+
+    Sends don't suspend: runtime.send() is a plain send_multipart() (which only blocks at the HWM, so keep the HWM
+    of the sockets used here away from it). A socket can be awaited by several coroutines, each message goes to the
+    one waiting longest. A mostly idle peer costs a suspended generator instead of a thread and its stack, and no
+    thread is ever stuck in a C call - every wait has a timeout if asked for.
+    """
+
+    def __init__(self, context=None, reactor=None):
+        self.context = context or zmq.Context.instance()
+        self.reactor = reactor or Reactor()
+        self._ready = collections.deque()  # (coroutine, value to resume it with)
+        self._timers = []  # heap of (deadline, seq, waiter, value)
+        self._seq = itertools.count()
+        self._waiting = {}  # socket -> deque of waiters in recv()
+        self._inbox = {}  # socket -> deque of messages nobody was waiting for yet
+        self.tasks = set()
+        self._running = False
+
+    def spawn(self, coroutine):
+        self.tasks.add(coroutine)
+        self._ready.append((coroutine, None))
+        return coroutine
+
+    def semaphore(self, value):
+        return Semaphore(self, value)
+
+    def socket(self, sock_type, bind=None, connect=None):
+        sock = self.context.socket(sock_type)
+        sock.setsockopt(zmq.LINGER, 0)
+        if bind:
+            sock.bind(bind)
+        if connect:
+            sock.connect(connect)
+        self._waiting[sock] = collections.deque()
+        self._inbox[sock] = collections.deque()
+        self.reactor.register(sock, self._on_message)
+        return sock
+
+    def close(self, sock):
+        self.reactor.unregister(sock)
+        self._waiting.pop(sock, None)
+        self._inbox.pop(sock, None)
+        sock.close()
+
+    def send(self, sock, frames):
+        self.reactor.send(sock, frames)
+
+    def _resume(self, waiter, value):
+        if waiter.done:
+            return False
+        waiter.done = True
+        self._ready.append((waiter.coroutine, value))
+        return True
+
+    def _call_later(self, delay, waiter, value=None):
+        heapq.heappush(self._timers, (time.time() + delay, next(self._seq), waiter, value))
+
+    def _on_message(self, sock, frames):
+        waiting = self._waiting[sock]
+        while waiting:
+            if self._resume(waiting.popleft(), frames):
+                return
+        self._inbox[sock].append(frames)
+
+    def recv(self, sock, timeout=None):
+        def wait(coroutine):
+            inbox = self._inbox[sock]
+            if inbox:
+                self._ready.append((coroutine, inbox.popleft()))
+                return
+            waiter = _Waiter(coroutine)
+            self._waiting[sock].append(waiter)
+            if timeout is not None:
+                self._call_later(timeout, waiter)
+        return wait
+
+    def sleep(self, seconds):
+        def wait(coroutine):
+            self._call_later(seconds, _Waiter(coroutine))
+        return wait
+
+    def _step(self, coroutine, value):
+        try:
+            wait = coroutine.send(value)
+        except StopIteration:
+            self.tasks.discard(coroutine)
+            return
+        except Exception:
+            log_runtime.exception("Task failed")
+            self.tasks.discard(coroutine)
+            return
+        wait(coroutine)
+
+    def run(self):
+        """Run until stop() is called or no task is left"""
+        self._running = True
+        while self._running and self.tasks:
+            while self._ready and self._running:
+                self._step(*self._ready.popleft())
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, waiter, value = heapq.heappop(self._timers)
+                self._resume(waiter, value)
+            if self._ready:
+                timeout = 0
+            elif self._timers:
+                timeout = max(self._timers[0][0] - time.time(), 0)
+            else:
+                timeout = None
+            self.reactor.poll(timeout)
+
+    def stop(self):
+        self._running = False
+
+    def shutdown(self):
+        """Close the remaining tasks (running their finally blocks) and sockets"""
+        for coroutine in list(self.tasks):
+            coroutine.close()
+        self.tasks.clear()
+        for sock in list(self._waiting):
+            self.close(sock)
+        self.reactor.close()
+
+
+READY = b"READY"
+
+
+def client_send(runtime, client_id, endpoint, limit, repeat=2, timeout=5.0):
+    """multithreaded_proxy.client_send as a coroutine; `limit` bounds the clients (and REQ sockets) alive at once"""
+    yield limit.acquire()
+    sock = runtime.socket(zmq.REQ, connect=endpoint)
+    try:
+        msg = b"Hello_%d" % client_id
+        for _ in range(repeat):
+            runtime.send(sock, [msg])
+            reply = yield runtime.recv(sock, timeout)
+            if reply is None:
+                log_client.warning("%d got no reply within %.1fs", client_id, timeout)
+                break  # the REQ socket is stuck now, it gets closed
+            log_client.debug("%d received %s", client_id, reply[0])
+    finally:
+        runtime.close(sock)
+        limit.release()
+
+
+def worker_routine(runtime, worker_id, worker_url, credit=1, work_time=0.01):
+    """
+    multithreaded_proxy.worker_routine as a coroutine: the same READY/credit protocol, but the requests it holds
+    are worked on concurrently, a sleep in one of them doesn't hold up the others
+    """
+    sock = runtime.socket(zmq.DEALER, connect=worker_url)
+
+    def handle(client_addr, request):
+        yield runtime.sleep(work_time)  # do some 'work'
+        runtime.send(sock, [client_addr, b"", b"World-%d" % worker_id])
+
+    try:
+        for _ in range(credit):
+            runtime.send(sock, [READY])
+        while True:
+            client_addr, empty, request = yield runtime.recv(sock)
+            log_worker.debug("%d - Received request: [ %s ]", worker_id, request)
+            runtime.spawn(handle(client_addr, request))
+    finally:
+        runtime.close(sock)
+
+
+def broker(runtime, clients, workers):
+    """
+    multithreaded_proxy.broker as two coroutines sharing the ready queue. The worker credit is a semaphore: the
+    client side only takes a request once some worker has credit, so requests wait in the clients socket as before.
+    """
+    ready = collections.deque()
+    credit = runtime.semaphore(0)
+
+    def from_workers():
+        while True:
+            frames = yield runtime.recv(workers)
+            ready.append(frames[0])
+            credit.release()
+            if frames[1:] != [READY]:
+                runtime.send(clients, frames[1:])  # [client_addr, "", reply]
+
+    def from_clients():
+        while True:
+            yield credit.acquire()
+            client_addr, empty, request = yield runtime.recv(clients)
+            while True:
+                try:
+                    runtime.send(workers, [ready.popleft(), client_addr, b"", request])
+                    break
+                except zmq.ZMQError as e:
+                    if e.errno != zmq.EHOSTUNREACH:
+                        raise
+                    log_runtime.info("Dropped the credit of a worker that went away")
+                    yield credit.acquire()
+
+    runtime.spawn(from_workers())
+    runtime.spawn(from_clients())
+
+
+def create_sub(runtime, publisher_url, topic_name, end_topic, received, timeout=5.0):
+    """
+    pub-sub.create_sub as a coroutine, counts the messages in `received`. Gives up if nothing arrives within
+    `timeout`, e.g. when the end message went out before the subscription reached the publisher.
+    """
+    sock = runtime.socket(zmq.SUB, connect=publisher_url)
+    sock.setsockopt(zmq.SUBSCRIBE, topic_name)
+    try:
+        while True:
+            frames = yield runtime.recv(sock, timeout)
+            if frames is None:
+                log_sub.warning("%s got nothing within %.1fs, giving up", topic_name, timeout)
+                break
+            topic, msg = frames
+            received[topic_name] += 1
+            if topic == end_topic:
+                break
+    finally:
+        runtime.close(sock)
+
+
+def main():
+    """
+    2000 logical clients, at most 200 of them (and their REQ sockets) at a time, through the load-balancing broker
+    to 4 workers holding 10 requests each; then 200 subscribers. One thread, no blocked recv() anywhere.
+
+    The publisher is an XPUB passing up every subscription (XPUB_VERBOSE) and only publishes once all subscribers
+    are in, so none of them misses an update or the end message and the demo always ends.
+    """
+    runtime = Runtime()
+    N_CLIENTS = 2000
+    clients = runtime.socket(zmq.ROUTER, bind="tcp://*:5555")
+    workers = runtime.socket(zmq.ROUTER, bind="inproc://workers")
+    workers.setsockopt(zmq.ROUTER_MANDATORY, 1)
+    broker(runtime, clients, workers)
+    for worker_id in range(4):
+        runtime.spawn(worker_routine(runtime, worker_id, "inproc://workers", credit=10))
+
+    limit = runtime.semaphore(200)
+
+    def run_clients():
+        started = time.time()
+        pending = [runtime.spawn(client_send(runtime, i, "tcp://127.0.0.1:5555", limit)) for i in range(N_CLIENTS)]
+        while any(client in runtime.tasks for client in pending):
+            yield runtime.sleep(0.05)
+        log_client.info("%d clients done in %.2fs", N_CLIENTS, time.time() - started)
+        runtime.stop()
+
+    runtime.spawn(run_clients())
+    runtime.run()
+    runtime.shutdown()
+
+    runtime = Runtime()
+    N_SUBS = 200
+    publisher = runtime.socket(zmq.XPUB)
+    publisher.setsockopt(zmq.XPUB_VERBOSE, 1)  # also the duplicate subscriptions, one per subscriber
+    publisher.bind("tcp://*:5556")
+    received = collections.Counter()
+
+    def publish():
+        subscribed = 0
+        while subscribed < N_SUBS:  # no slow joiners: wait for the subscriptions instead of sleeping
+            frames = yield runtime.recv(publisher, timeout=5.0)
+            if frames is None:
+                log_sub.warning("Only %d of %d subscribers joined, publishing anyway", subscribed, N_SUBS)
+                break
+            if frames[0][:1] == b"\x01":
+                subscribed += 1
+        for i in range(10):
+            runtime.send(publisher, [b"A", b"Update %d" % i])
+            runtime.send(publisher, [b"B", b"Update %d" % i])
+        runtime.send(publisher, [b"A-end", b"Last update"])
+        runtime.send(publisher, [b"B-end", b"Last update"])
+
+    topics = [b"A", b"B"]
+    for i in range(N_SUBS):
+        topic = topics[i % 2]
+        runtime.spawn(create_sub(runtime, "tcp://127.0.0.1:5556", topic, topic + b"-end", received))
+    runtime.spawn(publish())
+    runtime.run()
+    log_sub.info("Received per topic: %s", dict(received))
+    runtime.shutdown()
+    zmq.Context.instance().term()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+import bisect
+import errno
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+import zmq
+
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
+log_store = logging.getLogger(name="STORE")
+log_consumer = logging.getLogger(name="CONSUMER")
+log_producer = logging.getLogger(name="PRODUCER")
+
+RECORD = struct.Struct("!III")  # payload length, crc32 of the payload, number of frames
+FRAME = struct.Struct("!I")  # frame length, followed by the frame
+OFFSET = struct.Struct("!Q")
+COUNT = struct.Struct("!I")
+
+FETCH = b"FETCH"
+ACK = b"ACK"
+END = b"END"
+
+try:
+    memoryview(mmap.mmap(-1, 1))
+    _NEW_BUFFERS = True
+except TypeError:  # Python 2 mmaps only have the old buffer interface
+    _NEW_BUFFERS = False
+
+
+class Segment(object):
+    """
+    One preallocated, memory-mapped file of the log, named after the offset of its first message.
+
+    Records are [RECORD header][FRAME header, frame]... and the header is written last, so a zeroed header marks the
+    end of the data. On open the records are scanned to rebuild the index; a record whose crc doesn't match was torn
+    by a crash and ends the segment.
+    """
+
+    def __init__(self, path, base_offset, size):
+        self.path = path
+        self.base_offset = base_offset
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self._map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self._view = memoryview(self._map) if _NEW_BUFFERS else None
+        self.positions = []  # byte position of every record
+        self.end = self._recover()
+
+    def _recover(self):
+        pos = 0
+        while pos + RECORD.size <= self.size:
+            length, crc, n_frames = RECORD.unpack_from(self._map, pos)
+            if not n_frames:
+                return pos
+            end = pos + RECORD.size + length
+            if end > self.size or zlib.crc32(self._map[pos + RECORD.size:end]) & 0xffffffff != crc:
+                log_store.warning("%s: torn record at byte %d, dropping the rest of the segment", self.path, pos)
+                self._map[pos:] = b"\0" * (self.size - pos)
+                return pos
+            self.positions.append(pos)
+            pos = end
+        return pos
+
+    def append(self, frames):
+        """Copy the message into the mapping, False if it doesn't fit into this segment any more"""
+        length = sum(FRAME.size + len(frame) for frame in frames)
+        if self.end + RECORD.size + length > self.size:
+            return False
+        pos = self.end + RECORD.size
+        crc = 0
+        for frame in frames:
+            header = FRAME.pack(len(frame))
+            self._map[pos:pos + FRAME.size] = header
+            self._map[pos + FRAME.size:pos + FRAME.size + len(frame)] = frame
+            crc = zlib.crc32(frame, zlib.crc32(header, crc))
+            pos += FRAME.size + len(frame)
+        self._map[self.end:self.end + RECORD.size] = RECORD.pack(length, crc & 0xffffffff, len(frames))
+        self.positions.append(self.end)
+        self.end = pos
+        return True
+
+    def _frame(self, start, size):
+        if self._view is not None:
+            return self._view[start:start + size]
+        return buffer(self._map, start, size)
+
+    def read(self, index):
+        """The frames of the index-th message as views into the mapping, nothing is copied"""
+        pos = self.positions[index]
+        n_frames = RECORD.unpack_from(self._map, pos)[2]
+        pos += RECORD.size
+        frames = []
+        for _ in range(n_frames):
+            size = FRAME.unpack_from(self._map, pos)[0]
+            frames.append(self._frame(pos + FRAME.size, size))
+            pos += FRAME.size + size
+        return frames
+
+    def __len__(self):
+        return len(self.positions)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._view = None
+        try:
+            self._map.close()
+        except BufferError:  # frames still referenced (e.g. queued with copy=False), unmapped once they are freed
+            pass
+
+
+class DurableLog(object):
+    """
+    Append-only message log in `directory`, split into memory-mapped segments of segment_size bytes.
+
+    append() is a memory copy into the mapping, no write syscall per message. The mappings are flushed to disk
+    (msync) in batches, every sync_every messages or sync_interval seconds, or by sync(); a crash loses at most the
+    last unsynced batch. Consumers are tracked by name: commit() records the offset of the next message a consumer
+    needs, which is persisted with the next sync, and retain() deletes the segments every consumer is done with.
+    """
+
+    OFFSETS_FILE = "offsets.json"
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, sync_every=1000, sync_interval=0.1):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        bases = sorted(int(name[:-len(".log")]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.segments = [Segment(self._path(base), base, segment_size) for base in bases or [0]]
+        self._bases = [segment.base_offset for segment in self.segments]
+        try:
+            with open(os.path.join(directory, self.OFFSETS_FILE)) as offsets:
+                self.offsets = json.load(offsets)
+        except IOError:
+            self.offsets = {}
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _path(self, base_offset):
+        return os.path.join(self.directory, "%020d.log" % base_offset)
+
+    @property
+    def first_offset(self):
+        return self.segments[0].base_offset
+
+    @property
+    def next_offset(self):
+        return self.segments[-1].base_offset + len(self.segments[-1])
+
+    def append(self, frames):
+        """Store a message, returns its offset"""
+        offset = self.next_offset
+        if not self.segments[-1].append(frames):
+            if RECORD.size + sum(FRAME.size + len(frame) for frame in frames) > self.segment_size:
+                raise ValueError("message bigger than a segment (%d bytes)" % self.segment_size)
+            self.segments[-1].flush()
+            self.segments.append(Segment(self._path(offset), offset, self.segment_size))
+            self._bases.append(offset)
+            self.segments[-1].append(frames)
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+        return offset
+
+    def read(self, offset):
+        """The frames of the message at offset, as views into the mapped segment (valid until retain() drops it)"""
+        if not self.first_offset <= offset < self.next_offset:
+            raise IndexError("offset %d not in the log [%d, %d)" % (offset, self.first_offset, self.next_offset))
+        segment = self.segments[bisect.bisect_right(self._bases, offset) - 1]
+        return segment.read(offset - segment.base_offset)
+
+    def commit(self, consumer, offset):
+        self.offsets[consumer] = max(offset, self.offsets.get(consumer, 0))
+
+    def sync(self):
+        """Flush the appended messages and the committed offsets to disk"""
+        if self._unsynced:
+            self.segments[-1].flush()
+            self._unsynced = 0
+        path = os.path.join(self.directory, self.OFFSETS_FILE)
+        with open(path + ".tmp", "w") as offsets:
+            json.dump(self.offsets, offsets)
+            offsets.flush()
+            os.fsync(offsets.fileno())
+        os.rename(path + ".tmp", path)  # atomic, a crash leaves either the old or the new offsets
+        self._last_sync = time.time()
+
+    def retain(self):
+        """Delete the segments whose messages every known consumer has committed, returns how many"""
+        if not self.offsets:
+            return 0
+        done = min(self.offsets.values())
+        deleted = 0
+        while len(self.segments) > 1 and self.segments[1].base_offset <= done:
+            segment = self.segments.pop(0)
+            self._bases.pop(0)
+            segment.close()
+            os.remove(segment.path)
+            deleted += 1
+        return deleted
+
+    def close(self):
+        self.sync()
+        for segment in self.segments:
+            segment.close()
+
+
+class StoreAndForward(object):
+    """
+    Broker stage between producers and consumers that don't have to be there at the same time.
+
+    Producers PUSH messages to `inbound`, each is appended to the log before anything else happens to it. Consumers
+    pull from the ROUTER `outbound` at their own pace:
+        [FETCH, consumer, offset, max] -> up to max [offset, frames...] messages starting at offset, then [END];
+                                          an empty offset means from the consumer's last committed offset
+        [ACK, consumer, offset]        -> the consumer processed everything before offset
+    Unacknowledged messages are delivered again after a consumer or broker restart (at least once). Replayed
+    messages are sent with copy=False straight from the mapped segments.
+    """
+
+    def __init__(self, log, context, inbound_endpoint, outbound_endpoint):
+        self.log = log
+        self.inbound = context.socket(zmq.PULL)
+        self.inbound.bind(inbound_endpoint)
+        self.outbound = context.socket(zmq.ROUTER)
+        self.outbound.bind(outbound_endpoint)
+        self._poller = zmq.Poller()
+        self._poller.register(self.inbound, zmq.POLLIN)
+        self._poller.register(self.outbound, zmq.POLLIN)
+
+    def _fetch(self, identity, consumer, offset, count):
+        offset = OFFSET.unpack(offset)[0] if offset else self.log.offsets.get(consumer, self.log.first_offset)
+        offset = max(offset, self.log.first_offset)
+        for current in range(offset, min(offset + COUNT.unpack(count)[0], self.log.next_offset)):
+            self.outbound.send_multipart([identity, OFFSET.pack(current)] + self.log.read(current), copy=False)
+        self.outbound.send_multipart([identity, END])
+
+    def poll(self, timeout=None):
+        """Store what producers sent and answer the consumers, waiting up to timeout ms"""
+        sockets = dict(self._poller.poll(timeout))
+        if self.inbound in sockets:
+            while self.inbound.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                self.log.append(self.inbound.recv_multipart())
+        if self.outbound in sockets:
+            while self.outbound.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                frames = self.outbound.recv_multipart()
+                if frames[1] == FETCH and len(frames) == 5:
+                    self._fetch(frames[0], frames[2].decode("utf-8"), frames[3], frames[4])
+                elif frames[1] == ACK and len(frames) == 4:
+                    self.log.commit(frames[2].decode("utf-8"), OFFSET.unpack(frames[3])[0])
+        if not sockets:
+            self.log.sync()  # idle, don't leave a partial batch unsynced
+
+    def run(self, stop):
+        while not stop.is_set():
+            self.poll(100)
+
+    def close(self):
+        self.inbound.close()
+        self.outbound.close()
+
+
+class DurableConsumer(object):
+    """Consumer side of StoreAndForward: fetches batches from where it is and acknowledges what it processed"""
+
+    def __init__(self, context, endpoint, name, batch=100):
+        self.name = name.encode("utf-8")
+        self.batch = batch
+        self.offset = None  # next offset to fetch, None until the broker told us
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.connect(endpoint)
+
+    def fetch(self, timeout=None):
+        """Return up to `batch` messages as (offset, frames), empty if there is nothing new"""
+        offset = b"" if self.offset is None else OFFSET.pack(self.offset)
+        self.socket.send_multipart([FETCH, self.name, offset, COUNT.pack(self.batch)])
+        messages = []
+        while True:
+            if not self.socket.poll(timeout):
+                raise zmq.Again()
+            frames = self.socket.recv_multipart()
+            if frames == [END]:
+                return messages
+            offset = OFFSET.unpack(frames[0])[0]
+            messages.append((offset, frames[1:]))
+            self.offset = offset + 1
+
+    def ack(self):
+        """Everything fetched so far was processed"""
+        if self.offset is not None:
+            self.socket.send_multipart([ACK, self.name, OFFSET.pack(self.offset)])
+
+    def close(self):
+        self.socket.close(linger=1000)  # let the last ack go out
+
+
+def main():
+    """
+    The producer sends while no consumer exists; the messages are on disk instead of in a HWM queue. A consumer
+    processes half of them and goes away, a second one with the same name continues at the first unacknowledged
+    message. Run it again: the log survives restarts and the consumer only gets what came after its ack.
+    """
+    context = zmq.Context.instance()
+    log = DurableLog("/tmp/durable-queue", segment_size=1024 * 1024)
+    log_store.info("Log has offsets %d..%d, committed: %s", log.first_offset, log.next_offset, log.offsets)
+    stage = StoreAndForward(log, context, "tcp://*:5557", "tcp://*:5558")
+    stop = threading.Event()
+    stage_thread = threading.Thread(target=stage.run, args=(stop,))
+    stage_thread.start()
+
+    producer = context.socket(zmq.PUSH)
+    producer.connect("tcp://127.0.0.1:5557")
+    N_MSGS = 10000
+    for i in range(N_MSGS):
+        producer.send_multipart([b"job", b"%d" % i])
+    log_producer.info("Sent %d messages, no consumer around", N_MSGS)
+    producer.close(linger=-1)
+    time.sleep(0.5)
+
+    for consumer_nr in range(2):
+        consumer = DurableConsumer(context, "tcp://127.0.0.1:5558", "worker", batch=1000)
+        processed = 0
+        while processed < N_MSGS // 2:
+            messages = consumer.fetch(5000)
+            if not messages:
+                break
+            processed += len(messages)
+            consumer.ack()
+        log_consumer.info("Consumer %d processed offsets up to %s", consumer_nr + 1, consumer.offset)
+        consumer.close()
+        time.sleep(0.2)  # give the broker the ack before the next consumer asks
+
+    stop.set()
+    stage_thread.join()
+    stage.close()
+    log_store.info("Deleted %d segments every consumer is done with", log.retain())
+    log.close()
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import zmq
+
+
+log_endpoints = logging.getLogger(name="ENDPOINTS")
+
+HAS_IPC = zmq.has("ipc") if hasattr(zmq, "has") else os.name == "posix"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class EndpointRegistry(object):
+    """
+    Services by name instead of hard-coded endpoint strings, connected over the cheapest transport that works.
+
+    bind() binds a socket on every transport that makes sense - inproc://name, ipc://<directory>/name.ipc and, given a
+    port, tcp - and records where. connect() then picks for the connecting socket:
+    - inproc:// if the service is bound in the same context (no syscalls, no copies through the kernel)
+    - ipc:// if it runs on the same host (unix socket, skips the TCP stack)
+    - tcp:// otherwise
+    Records of this process are kept in memory, with the context the service is bound in, records of other processes
+    on the host are read from JSON files in `directory` (those of dead processes are ignored), and services on other
+    hosts can be added with add().
+    """
+
+    def __init__(self, directory="/tmp/zmq-endpoints", advertise_host=None):
+        self.directory = directory
+        self.host = socket.gethostname()
+        self.advertise_host = advertise_host or self.host
+        self._records = {}  # name -> record, bound in this process or added
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, name):
+        return os.path.join(self.directory, "%s.json" % name)
+
+    def bind(self, sock, name, context, tcp_port=None):
+        """Bind sock for the service `name`; tcp_port 0 binds a random port. Returns the record"""
+        record = {"host": self.host, "pid": os.getpid(), "inproc": "inproc://%s" % name}
+        sock.bind(record["inproc"])
+        if HAS_IPC:
+            record["ipc"] = "ipc://%s" % os.path.join(self.directory, "%s.ipc" % name)
+            sock.bind(record["ipc"])
+        if tcp_port is not None:
+            if tcp_port == 0:
+                tcp_port = sock.bind_to_random_port("tcp://*")
+            else:
+                sock.bind("tcp://*:%d" % tcp_port)
+            record["tcp"] = "tcp://%s:%d" % (self.advertise_host, tcp_port)
+        with open(self._path(name) + ".tmp", "w") as record_file:
+            json.dump(record, record_file)
+        os.rename(self._path(name) + ".tmp", self._path(name))
+        record["context"] = context  # the object itself, an id() may be reused once the context is gone
+        with self._lock:
+            self._records[name] = record
+        return record
+
+    def add(self, name, tcp):
+        """Register a service of another host by its tcp endpoint"""
+        with self._lock:
+            self._records[name] = {"host": None, "pid": None, "context": None, "tcp": tcp}
+
+    def unregister(self, name):
+        with self._lock:
+            record = self._records.pop(name, None)
+        if record is not None and record["pid"] == os.getpid():
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def _lookup(self, name):
+        with self._lock:
+            record = self._records.get(name)
+        if record is not None:
+            return record
+        try:
+            with open(self._path(name)) as record_file:
+                record = json.load(record_file)
+        except (IOError, ValueError):
+            return None
+        if record["host"] == self.host and not _pid_alive(record["pid"]):
+            return None  # left behind by a process that is gone
+        return record
+
+    def candidates(self, name, context=None, timeout=None):
+        """
+        Endpoints of the service from the cheapest to the most expensive transport, waiting up to timeout seconds
+        (None: forever) for it to be bound. Raises KeyError if it doesn't show up in time.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        record = self._lookup(name)
+        while record is None:
+            if deadline is not None and time.time() >= deadline:
+                raise KeyError("no service %r in the registry" % name)
+            time.sleep(0.05)
+            record = self._lookup(name)
+        endpoints = []
+        if context is not None and record.get("context") is context:
+            endpoints.append(record["inproc"])
+        if record["host"] == self.host and HAS_IPC and "ipc" in record:
+            endpoints.append(record["ipc"])
+        if "tcp" in record:
+            endpoints.append(record["tcp"])
+        return endpoints
+
+    def resolve(self, name, context=None, timeout=None):
+        """The endpoint connect() would try first"""
+        endpoints = self.candidates(name, context, timeout)
+        if not endpoints:
+            raise KeyError("service %r is not reachable from here" % name)
+        return endpoints[0]
+
+    def connect(self, sock, name, context=None, timeout=None):
+        """
+        Connect sock to the service over the cheapest transport, returns the endpoint used.
+
+        There is no falling back: connect() is asynchronous and succeeds whether or not anybody listens, zmq keeps
+        reconnecting in the background. The record is what tells which transports reach the service.
+        """
+        endpoint = self.resolve(name, context, timeout)
+        sock.connect(endpoint)
+        log_endpoints.debug("%s: connected over %s", name, endpoint)
+        return endpoint
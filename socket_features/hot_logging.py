@@ -0,0 +1,115 @@
+import atexit
+import logging
+import Queue
+import sys
+import threading
+
+
+class Lazy(object):
+    """
+    A log argument computed only if the record is really formatted, e.g. Lazy(binascii.hexlify, frame).
+
+    logging already formats the message lazily, but the arguments are evaluated at the call site: a .encode('hex')
+    of every frame costs the same whether the record is emitted or not.
+    """
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+    __repr__ = __str__
+
+
+class HotLogger(object):
+    """
+    Wraps a logger for call sites on the per-message path.
+
+    Only the first and then every `sample`-th call is looked at at all; the others cost an integer increment and a
+    compare, no LogRecord, no level check, no argument formatting. A sampled record tells how many calls it stands for. The
+    counter isn't locked: with threads the sampling is approximate, which is fine for logging.
+    """
+
+    def __init__(self, logger, sample=1):
+        self.logger = logger
+        self.sample = sample
+        self._calls = sample - 1  # the first call gets through
+
+    def log(self, level, msg, *args):
+        self._calls += 1
+        if self._calls < self.sample:
+            return
+        self._calls = 0
+        if self.logger.isEnabledFor(level):
+            if self.sample > 1:
+                msg = "%s [1/%d sampled]" % (msg, self.sample)
+            self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+
+class AsyncHandler(logging.Handler):
+    """
+    QueueHandler-style sink: emit() only puts the record into a bounded queue, a thread formats it and passes it to
+    the real handlers. The logging thread never waits for the formatting or the I/O; when the queue is full the
+    record is dropped and counted in `dropped` instead of blocking a hot path.
+
+    The arguments are formatted on the sink thread, so don't log objects that are modified right after the call
+    (pass a copy or format them with Lazy beforehand).
+    """
+
+    def __init__(self, handlers, capacity=10000):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.dropped = 0
+        self._queue = Queue.Queue(capacity)
+        self._thread = threading.Thread(target=self._run, name="Log-sink")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def close(self):
+        """Write out what is queued and stop the sink thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self.dropped:  # not through logging, this handler is the way there
+            sys.stderr.write("%d log records dropped, the sink fell behind\n" % self.dropped)
+            self.dropped = 0
+        for handler in self.handlers:
+            handler.flush()
+        logging.Handler.close(self)
+
+
+def install_async_logging(logger=None, capacity=10000):
+    """
+    Move the handlers of logger (the root logger by default, as set up by basicConfig()) behind an AsyncHandler.
+    The queue is drained at exit.
+    """
+    logger = logger or logging.getLogger()
+    handler = AsyncHandler(logger.handlers, capacity)
+    logger.handlers = [handler]
+    atexit.register(handler.close)
+    return handler
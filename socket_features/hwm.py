@@ -3,6 +3,10 @@ import signal
 import threading
 import zmq
 
+from hwm_controller import HWMController
+from reactor import Reactor
+from telemetry import InstrumentedSocket, Telemetry
+
 
 logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
 log_sender = logging.getLogger(name="SENDER")
@@ -10,14 +14,19 @@ log_receiver = logging.getLogger(name="RECEIVER")
 log_common = logging.getLogger(name="Helper")
 
 
-def test_blocking_on_reaching_sndhwm(context, sock_type):
+def test_blocking_on_reaching_sndhwm(context, sock_type, telemetry=None):
     """
     Works as expected but note that there is no peer bound to that address so the messages stay in the input queue
+    (the telemetry shows no CONNECTED event and all sent messages in flight)
+
+    The SNDHWM starts at 5 and is tuned by an HWMController whenever the socket goes mute. Nobody drains the queue,
+    so it grows up to max_hwm (reconnecting drops what was queued) and then the send blocks for good.
     """
     log_common.info("Testing blocking on reaching send HWM")
     context = zmq.Context()
-    socket = context.socket(sock_type)
+    socket = InstrumentedSocket(context.socket(sock_type), "sender", telemetry)
     socket.setsockopt(zmq.SNDHWM, 5)
+    controller = HWMController(socket, max_hwm=50, kernel_buffer=None)  # never connects, no kernel buffers
     log_sender.info("Set sndhwm to %d", socket.sndhwm)
     socket.connect('tcp://127.0.0.1:5555')
 
@@ -25,7 +34,12 @@ def test_blocking_on_reaching_sndhwm(context, sock_type):
 
     while True:
         try:
-            socket.send("block")
+            try:
+                socket.send("block", zmq.NOBLOCK)
+            except zmq.Again:
+                if controller.update():
+                    continue  # retry on the reconnected pipe
+                socket.send("block")
             out_msgs_queued += 1
             log_sender.info("Queued %d messages so far", out_msgs_queued)
         except zmq.ZMQError:
@@ -57,30 +71,32 @@ def saturate_receiver_threads(context, sock_type, endpoint, total_msgs):
     return threads
 
 
-def saturate_receiver_no_threads(context, sock_type, endpoint, total_msgs):
+def saturate_receiver_no_threads(context, sock_type, endpoint, total_msgs, telemetry=None):
     senders = []
     for i in range(total_msgs):
-        sender = context.socket(sock_type)
+        sender = InstrumentedSocket(context.socket(sock_type), "sender-%d" % (i+1), telemetry)
         sender.connect(endpoint)
         msg = str(i+1)
         sender.send(msg)
         log_sender.info("Sent: %s", msg)
         senders.append(sender)
-    poller = zmq.Poller()
+
+    def on_reply(sock, msg):
+        log_sender.info("Recv: %s", msg)
+        reactor.unregister(sock)
+
+    reactor = Reactor()
     for sock in senders:
-        poller.register(sock, zmq.POLLIN)
+        reactor.register(sock, on_reply)
 
-    while True:
-        try:
-            poller.poll(timeout=1)
-        except zmq.Again:
-            log_common.info("Timeout passed")
-        except zmq.ZMQError as e:
-            log_common.info("Got error %d - %s", e.errno, e.strerror)
-            for sock in senders:
-                poller.unregister(sock)
-                sock.close()
-            break
+    try:
+        reactor.run()  # sleeps in epoll_wait until a reply or a signal arrives instead of spinning on poll(timeout=1)
+    except (IOError, OSError, zmq.ZMQError) as e:
+        log_common.info("Got error %d - %s", e.errno, e.strerror)
+    finally:
+        reactor.close()
+        for sock in senders:
+            sock.close()
 
 
 def test_blocking_on_reaching_rcvhwm(context, sock_type_receiver, sock_type_sender):
@@ -89,15 +105,23 @@ def test_blocking_on_reaching_rcvhwm(context, sock_type_receiver, sock_type_send
 
     Perhaps the messages are actually sent and the input queue for the sender is emptied and the messages are queued
     in output of the receiver. But then why it doesn't block after RCVHVM_LIMIT messages ???
+
+    The telemetry answers it: the receiver ACCEPTED one connection per sender, no sender is mute and all messages are
+    in flight on the endpoint - they left the senders and wait in the receiver's queues. The HWM applies per
+    connection (pipe), not per socket, and every sender queues a single message on its own pipe, so no pipe ever gets
+    near RCVHVM_LIMIT.
     """
     log_common.info("Testing blocking on reaching rcvhwm HWM")
-    socket = context.socket(sock_type_receiver)
+    telemetry = Telemetry(interval=1.0)
+    telemetry.start()
+    socket = InstrumentedSocket(context.socket(sock_type_receiver), "receiver", telemetry)
     RCVHVM_LIMIT = 5
     socket.setsockopt(zmq.RCVHWM, RCVHVM_LIMIT)
     log_receiver.info("Set rcvhwm to %d", socket.rcvhwm)
     endpoint_receiver = "tcp://127.0.0.1:5555"
     socket.bind(endpoint_receiver)
-    saturate_receiver_no_threads(context, sock_type_sender, endpoint_receiver, RCVHVM_LIMIT*2 + 3)
+    saturate_receiver_no_threads(context, sock_type_sender, endpoint_receiver, RCVHVM_LIMIT*2 + 3, telemetry)
+    telemetry.stop()
 
 
 def main():
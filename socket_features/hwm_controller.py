@@ -0,0 +1,180 @@
+import logging
+import Queue
+import struct
+import threading
+import time
+import zmq
+
+from telemetry import InstrumentedSocket
+
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
+log_controller = logging.getLogger(name="HWM")
+log_sender = logging.getLogger(name="SENDER")
+
+
+class HWMController(object):
+    """
+    Tunes SNDHWM/RCVHWM of an InstrumentedSocket from what it observes, within a memory and a latency budget.
+
+    Every update() derives two limits per connection (the HWM applies per pipe):
+    - memory: memory_budget / number of peers / average message size
+    - latency: a full queue must drain within latency_budget, so by Little's law it may hold at most
+      latency_budget * messages per second. On tcp and ipc the kernel buffers queue messages too - for small
+      messages far more than the HWM - so the controller sets SNDBUF/RCVBUF to kernel_buffer bytes and subtracts
+      what they hold from that limit (our SNDBUF and the peer's RCVBUF, assumed to be the same size, both doubled by
+      Linux). The correction takes at most half of the limit: with small messages the buffers alone would cover the
+      whole budget and leave min_hwm, while the HWM still has to absorb bursts. kernel_buffer=None leaves the OS
+      defaults, which are then not accounted for.
+    The end-to-end latency reported with record_latency() corrects the estimate: over budget the HWM shrinks in the
+    same proportion, under budget it may grow the same way (at most doubling per update), so it recovers once the
+    queues drained. The smallest value wins, bounded by min_hwm/max_hwm. Changes smaller than `hysteresis` are
+    ignored.
+
+    libzmq only applies a new HWM to connections created afterwards, so by default every endpoint of the socket is
+    reconnected (or rebound). Messages still queued on the old pipes get at most RECONNECT_LINGER ms to go out and are
+    dropped after that; with the default infinite LINGER they would keep context.term() waiting forever. Pass `recreate` to do
+    it differently, e.g. to recreate a REQ socket between two requests. The buffer sizes are set right away, so create
+    the controller before the socket connects or binds. Call everything from the thread owning the socket.
+    """
+
+    MAX_GROWTH = 2.0
+    RECONNECT_LINGER = 100  # ms
+
+    def __init__(self, socket, memory_budget=64 * 1024 * 1024, latency_budget=0.1, min_hwm=1, max_hwm=100000,
+                 hysteresis=0.25, recreate=None, kernel_buffer=64 * 1024):
+        self.socket = socket
+        self.kernel_buffer = kernel_buffer
+        if kernel_buffer is not None:
+            socket.setsockopt(zmq.SNDBUF, kernel_buffer)
+            socket.setsockopt(zmq.RCVBUF, kernel_buffer)
+        self.memory_budget = memory_budget
+        self.latency_budget = latency_budget
+        self.min_hwm = min_hwm
+        self.max_hwm = max_hwm
+        self.hysteresis = hysteresis
+        self.recreate = recreate or self._reconnect
+        self.hwm = socket.getsockopt(zmq.SNDHWM)
+        self.latency = None  # exponentially weighted average in seconds
+        self._last = (time.time(), socket.stats.sends + socket.stats.receives,
+                      socket.stats.bytes_sent + socket.stats.bytes_received)
+
+    def record_latency(self, seconds, weight=0.2):
+        self.latency = seconds if self.latency is None else self.latency + weight * (seconds - self.latency)
+
+    def target(self):
+        stats = self.socket.stats
+        now = time.time()
+        msgs = stats.sends + stats.receives
+        n_bytes = stats.bytes_sent + stats.bytes_received
+        last_time, last_msgs, last_bytes = self._last
+        self._last = (now, msgs, n_bytes)
+        if msgs == last_msgs or now == last_time:
+            return self.hwm  # nothing observed, nothing to learn
+        rate = (msgs - last_msgs) / (now - last_time)
+        msg_size = max(float(n_bytes - last_bytes) / (msgs - last_msgs), 1.0)
+
+        peers = max(stats.peers, 1)
+        queued = self.latency_budget * rate
+        if self.kernel_buffer is not None:
+            queued -= min(4 * self.kernel_buffer / msg_size, queued / 2)
+        limit = min(self.memory_budget / peers / msg_size, queued)
+        if self.latency is not None:
+            limit = min(limit, self.hwm * min(self.latency_budget / max(self.latency, 1e-6), self.MAX_GROWTH))
+        return int(max(self.min_hwm, min(self.max_hwm, limit)))
+
+    def update(self):
+        """Re-evaluate the HWM, call it periodically. Returns True if the HWM was changed"""
+        target = self.target()
+        if abs(target - self.hwm) <= self.hysteresis * self.hwm:
+            return False
+        log_controller.info("%s: HWM %d -> %d (latency %s)", self.socket.stats.name, self.hwm, target, self.latency)
+        self.hwm = target
+        self.recreate(self.socket, target)
+        return True
+
+    @classmethod
+    def _reconnect(cls, socket, hwm):
+        socket.setsockopt(zmq.SNDHWM, hwm)
+        socket.setsockopt(zmq.RCVHWM, hwm)
+        raw = socket.socket  # the wrapper would record the endpoints again
+        linger = raw.getsockopt(zmq.LINGER)
+        if linger < 0 or linger > cls.RECONNECT_LINGER:  # the old pipes take the LINGER set when they are closed
+            raw.setsockopt(zmq.LINGER, cls.RECONNECT_LINGER)
+        try:
+            cls._reopen(socket, raw)
+        finally:
+            raw.setsockopt(zmq.LINGER, linger)
+
+    @staticmethod
+    def _reopen(socket, raw):
+        for endpoint in socket.connected:
+            raw.disconnect(endpoint)
+            raw.connect(endpoint)
+        for endpoint in socket.bound:
+            raw.unbind(endpoint)
+            for attempt in range(10):  # unbind is asynchronous, the address may be busy for a moment
+                try:
+                    raw.bind(endpoint)
+                    break
+                except zmq.ZMQError as e:
+                    if e.errno != zmq.EADDRINUSE or attempt == 9:
+                        raise
+                    time.sleep(0.01)
+
+
+def main():
+    """
+    A fast producer and a slow consumer: the controller shrinks the SNDHWM until a message spends about
+    latency_budget in the queues, instead of the fixed small values used in the other experiments. Both ends use
+    small kernel buffers, with the OS defaults they alone would hold seconds of these messages.
+    """
+    context = zmq.Context.instance()
+    endpoint = "tcp://127.0.0.1:5555"
+    KERNEL_BUFFER = 4096
+    padding = b"x" * 1024
+    latencies = Queue.Queue()
+    stop = threading.Event()
+
+    def consumer():
+        receiver = context.socket(zmq.PULL)
+        receiver.setsockopt(zmq.LINGER, 0)
+        receiver.setsockopt(zmq.RCVHWM, 10)
+        receiver.setsockopt(zmq.RCVBUF, KERNEL_BUFFER)
+        receiver.bind(endpoint)
+        while not stop.is_set():
+            if receiver.poll(100):
+                sent_at, = struct.unpack_from("!d", receiver.recv())
+                latencies.put(time.time() - sent_at)
+                time.sleep(0.001)  # slow consumer
+        receiver.close()
+
+    consumer_thread = threading.Thread(target=consumer)
+    consumer_thread.start()
+    sender = InstrumentedSocket(context.socket(zmq.PUSH), "producer")
+    sender.setsockopt(zmq.SNDHWM, 1000)
+    sender.setsockopt(zmq.LINGER, 0)  # what the slow consumer didn't take at the end is dropped
+    controller = HWMController(sender, latency_budget=0.1, kernel_buffer=KERNEL_BUFFER)
+    sender.connect(endpoint)
+
+    next_update = time.time() + 0.5
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            sender.send(struct.pack("!d", time.time()) + padding, zmq.NOBLOCK)
+        except zmq.Again:
+            time.sleep(0.001)  # mute, the queues are full
+        while not latencies.empty():
+            controller.record_latency(latencies.get())
+        if time.time() >= next_update:
+            controller.update()
+            next_update += 0.5
+    log_sender.info("Final HWM %d, latency %.4fs", controller.hwm, controller.latency)
+    stop.set()
+    consumer_thread.join()
+    sender.close(linger=0)
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@ import logging
 import random
 import zmq
 
+from reactor import Reactor
+
 
 logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
 log_server = logging.getLogger(name="SERVER")
@@ -24,9 +26,16 @@ def send_acks_simple(server, clients):
 
 
 def send_acks_poller(server, clients):
-    poller = zmq.Poller()
+    replies = []
+
+    def on_reply(sock, msg):
+        log_client.info("Client got: %s", msg)
+        reactor.unregister(sock)  # before the socket gets closed
+        replies.append(msg)
+
+    reactor = Reactor()
     for client_sock in clients.values():
-        poller.register(client_sock, zmq.POLLIN)
+        reactor.register(client_sock, on_reply)
 
     resp_order = []
     for _ in range(len(clients)):
@@ -36,19 +45,14 @@ def send_acks_poller(server, clients):
         server.send('ack')
         id = int(msg.split("_")[1])
         resp_order.append(id)
-        while True:
-            try:
-                sockets_ready = dict(poller.poll(timeout=None))
-                for sock in sockets_ready:  # should be always at most one
-                    msg = sock.recv()
-                    log_client.info("Client got: %s", msg)
-                    poller.unregister(sock)
-                break
-            except zmq.Again:
-                log_common.debug("None available")
+        while not replies:
+            reactor.poll()
+        replies.pop()
         clients[id].close()
+    reactor.close()
     return resp_order
 
+
 def main():
     """
     Check how binding a socket to multiple addresses works.
@@ -1,65 +1,162 @@
+import collections
 import logging
 import time
 import threading
 import zmq
 
+from endpoints import EndpointRegistry
+from hot_logging import HotLogger, Lazy, install_async_logging
+from reliable_client import LazyPirateClient
+from tracing import BROKER_IN, BROKER_OUT, BROKER_REPLY, CLIENT_RECV, WORKER_IN, WORKER_OUT
+from tracing import TraceCollector, split_trace, stamp, stamped, start_trace
+from worker_pool import WorkerPool
+
 
 logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
 log_worker = logging.getLogger(name="WORKER")
 log_client = logging.getLogger(name="CLIENT")
 log_common = logging.getLogger(name="Helper")
+hot_worker = HotLogger(log_worker, sample=10)  # once per request: only 1 in 10 is logged
+hot_client = HotLogger(log_client, sample=10)
 
 url_worker = "inproc://workers"
-url_client = "tcp://*:5555"
-url_server = "tcp://127.0.0.1:5555"
+url_worker_ipc = "ipc:///tmp/workers"  # processes can't use inproc
+clients_tcp_port = 5555  # for clients in other processes or on other hosts, local ones get inproc:// or ipc://
+registry = EndpointRegistry()
 
 
-def client_send(client_id, context, endpoint):
-    socket = context.socket(zmq.REQ)
-    socket.connect(endpoint)
+def client_send(client_id, client, collector=None):
+    """
+    The requests go through a shared LazyPirateClient: a stalled server means a retry, not a hung thread.
+    Given a TraceCollector every request carries a trace frame in front of the body and the stamped trace of the
+    reply is handed to the collector.
+    """
     msg = "Hello_%s" % client_id
     REPEAT = 2
     for i in range(REPEAT):
-        socket.send(msg)
-        log_client.info("%s sent %s", client_id, msg)
-        log_client.info("%s received %s", client_id, socket.recv())
-    socket.close()
+        hot_client.info("%s sent %s", client_id, msg)
+        try:
+            trace, reply = split_trace(client.request([msg] if collector is None else [start_trace(), msg]))
+        except zmq.Again:
+            log_client.error("%s gave up on %s", client_id, msg)
+            continue
+        if trace is not None:
+            collector.record(stamp(trace, CLIENT_RECV))
+        hot_client.info("%s received %s", client_id, reply[0])
 
 
-def start_clients():
-    context = zmq.Context.instance()
+def start_clients(client, collector=None):
     # Launch some clients
     client_threads = []
     for i in range(3):
-        thread = threading.Thread(target=client_send, args=(i, context, url_server,))
+        thread = threading.Thread(target=client_send, args=(i, client, collector))
         thread.start()
         client_threads.append(thread)
     return client_threads
 
 
-def worker_routine(worker_id, context, worker_url):
-    """Worker routine"""
-    # Socket to talk to dispatcher
-    socket = context.socket(zmq.REP)
+READY = b"READY"
 
-    socket.connect(worker_url)
-
-    while True:
-        try:
-            string = socket.recv()
-        except zmq.ContextTerminated:
-            break
 
-        log_worker.info("%d - Received request: [ %s ]", worker_id, string)
+def body_start(frames):
+    """
+    Index of the first frame after the envelope, which runs up to and including the first empty frame - the way
+    a REP socket splits it. A REQ client sends no envelope of its own, a DEALER client (PipelinedClient) puts its
+    request id there.
+    """
+    return frames.index(b"") + 1
 
-        # do some 'work'
-        time.sleep(1)
 
-        #send reply back to client
-        socket.send(b"World-%d" % worker_id)
+def worker_routine(worker_id, context, worker_url, credit=1, stop=None):
+    """
+    Worker routine
 
+    The worker tells the broker how many requests it is willing to hold (credit) by sending that many READY
+    messages, and every reply gives one credit back. With credit=1 it only ever gets a request when it is idle.
+    Once `stop` is set the worker finishes the requests it already got and exits. A trace frame after the envelope
+    is stamped and returned with the reply.
+    """
+    # Socket to talk to dispatcher
+    socket = context.socket(zmq.DEALER)
 
-def start_server():
+    socket.connect(worker_url)
+    try:
+        for _ in range(credit):
+            socket.send(READY)
+
+        while True:
+            try:
+                if not socket.poll(100):
+                    if stop is not None and stop.is_set():
+                        break  # nothing left to drain
+                    continue
+                frames = socket.recv_multipart()  # [client_addr, (request_id,) "", (trace,) request...]
+            except zmq.ContextTerminated:
+                break
+
+            body = body_start(frames)
+            frames = stamped(frames, body, WORKER_IN)
+            envelope, request = frames[:body], frames[body:]  # the request may have several frames
+            trace, request = split_trace(request)
+            hot_worker.info("%d - Received request: [ %s ]", worker_id, Lazy(" ".join, request))
+
+            # do some 'work'
+            time.sleep(1)
+
+            #send reply back to client
+            reply = [b"World-%d" % worker_id]
+            socket.send_multipart(envelope + (reply if trace is None else [stamp(trace, WORKER_OUT)] + reply))
+    finally:
+        socket.close(linger=1000)  # a crashed worker disconnects, so the broker stops routing to it
+
+
+def broker(clients, workers, stop=None):
+    """
+    Load-balancing broker between a ROUTER facing the clients and a ROUTER facing the workers.
+
+    Unlike the QUEUE device (which round-robins blindly over a DEALER) a request is handed out only to a worker that
+    has credit left, so a slow worker never gets requests queued behind it while others are idle. Workers appear in
+    the ready queue once per credit. Clients are only polled while some worker is ready; until then their requests
+    wait in the clients socket. The workers socket must have ROUTER_MANDATORY set: the credit of a worker that went
+    away is dropped and the request goes to the next ready worker. Traced requests get stamped on the way in, on the
+    way to the worker and on the way back. They are only read once a worker has credit, so the wait for a worker
+    shows up in front of broker_in (client_send->broker_in), not between broker_in and broker_out.
+    """
+    ready = collections.deque()
+    pending = collections.deque()
+
+    poll_workers = zmq.Poller()
+    poll_workers.register(workers, zmq.POLLIN)
+    poll_both = zmq.Poller()
+    poll_both.register(workers, zmq.POLLIN)
+    poll_both.register(clients, zmq.POLLIN)
+
+    while stop is None or not stop.is_set():
+        sockets = dict((poll_both if ready else poll_workers).poll(100))
+
+        if workers in sockets:
+            frames = workers.recv_multipart()
+            worker_addr = frames[0]
+            ready.append(worker_addr)
+            if frames[1:] != [READY]:
+                # [client_addr, (request_id,) "", (trace,) reply]
+                clients.send_multipart(stamped(frames, body_start(frames), BROKER_REPLY)[1:])
+
+        if ready and clients in sockets:
+            frames = clients.recv_multipart()  # [client_addr, (request_id,) "", (trace,) request...]
+            pending.append(stamped(frames, body_start(frames), BROKER_IN))
+
+        while ready and pending:
+            try:
+                workers.send_multipart([ready.popleft()] + stamped(pending[0], body_start(pending[0]), BROKER_OUT))
+                pending.popleft()
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                log_common.info("Dropped the credit of a worker that went away")
+
+
+def start_server(pool, stop=None):
     """Server routine"""
 
     # Prepare our context and sockets
@@ -67,27 +164,29 @@ def start_server():
 
     # Socket to talk to clients
     clients = context.socket(zmq.ROUTER)
-    clients.bind(url_client)
+    registry.bind(clients, "clients", context, tcp_port=clients_tcp_port)
 
     # Socket to talk to workers
-    workers = context.socket(zmq.DEALER)
-    workers.bind(url_worker)
+    workers = context.socket(zmq.ROUTER)
+    workers.setsockopt(zmq.ROUTER_MANDATORY, 1)
+    workers.bind(pool.worker_url)
 
-    # Launch pool of worker threads
-    for i in range(2):
-        thread = threading.Thread(target=worker_routine, args=(i, context, url_worker,))
-        thread.start()
+    # Launch pool of workers
+    pool.start()
     try:
-        zmq.device(zmq.QUEUE, clients, workers)
+        broker(clients, workers, stop)
     except zmq.ContextTerminated:
-        clients.close()
-        workers.close()
+        pass
+    registry.unregister("clients")
+    clients.close()
+    workers.close()
 
 
-def main():
+def main(pool_mode="thread", trace=False):
     """
     Client receives the reply from the worker that got the request but further communication
-    can be done with any other free worker.
+    can be done with any other free worker. The broker only hands a request to an idle worker (credit=1), the sample
+    output below was taken with the QUEUE device which round-robins regardless of how busy a worker is.
 
     Sample output (3 clients, 2 workers):
 
@@ -109,13 +208,31 @@ def main():
     CLIENT: 2014-11-10 19:11:20,148: INFO: 2 received World-1
     CLIENT: 2014-11-10 19:11:21,138: INFO: 0 received World-0
     CLIENT: 2014-11-10 19:11:21,151: INFO: 1 received World-1
+
+    With trace=True the requests are traced and the per-hop latencies are logged every second by the TRACING logger.
     """
-    client_threads = start_clients()
-    proxy_thread = threading.Thread(target=start_server)
+    install_async_logging()  # workers and clients only queue their log records, a sink thread writes them
+    worker_url = url_worker if pool_mode == "thread" else url_worker_ipc
+    pool = WorkerPool(worker_routine, worker_url, mode=pool_mode, size=2)
+    stop = threading.Event()
+    proxy_thread = threading.Thread(target=start_server, args=(pool, stop))
     proxy_thread.start()
+    context = zmq.Context.instance()
+    url_server = registry.resolve("clients", context, timeout=10)  # same context as the broker: inproc://
+    log_common.info("Clients connect to %s", url_server)
+    client = LazyPirateClient(context, url_server)
+    collector = TraceCollector() if trace else None
+    if collector is not None:
+        collector.start()
+    client_threads = start_clients(client, collector)
     for client_thread in client_threads:
         client_thread.join()
-    context = zmq.Context.instance()
+    if collector is not None:
+        collector.stop()
+    client.close()
+    pool.stop()  # the broker keeps forwarding replies while the workers drain
+    stop.set()
+    proxy_thread.join()
     context.term()
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import select
+import zmq
+
+
+class Reactor(object):
+    """
+    Dispatches incoming messages of many zmq sockets from one thread, using Linux epoll on each socket's zmq.FD.
+
+    zmq.FD is edge-triggered: it signals that zmq.EVENTS may have changed, not that a message is waiting. So sockets
+    are registered once with EPOLLET, and a socket that wakes up is drained (zmq.EVENTS checked, recv with NOBLOCK)
+    until it has nothing left. One wake-up costs O(ready sockets), not O(registered sockets) like zmq.Poller.
+
+    Anything done to a socket can consume its edge without waking epoll - a recv or send made by a callback, or
+    messages already queued at register() time. Such sockets get re-checked on the next round: use send() or
+    check() so the reactor knows about them. A socket may hog at most max_batch messages per round.
+    """
+
+    def __init__(self, max_batch=256):
+        self.max_batch = max_batch
+        self._epoll = select.epoll()
+        self._handlers = {}  # fd -> (socket, callback)
+        self._fds = {}  # socket -> fd
+        self._recheck = set()
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def register(self, sock, callback):
+        """callback(sock, frames) is called for every multipart message sock receives"""
+        fd = sock.getsockopt(zmq.FD)
+        self._handlers[fd] = (sock, callback)
+        self._fds[sock] = fd
+        self._epoll.register(fd, select.EPOLLIN | select.EPOLLET)
+        self._recheck.add(fd)
+
+    def unregister(self, sock):
+        """Must be called before the socket is closed"""
+        fd = self._fds.pop(sock, None)
+        if fd is None:
+            return
+        del self._handlers[fd]
+        self._epoll.unregister(fd)
+        self._recheck.discard(fd)
+
+    def check(self, sock):
+        """Re-check sock on the next round, for when it was used outside of the reactor"""
+        fd = self._fds.get(sock)
+        if fd is not None:
+            self._recheck.add(fd)
+
+    def send(self, sock, frames, flags=0):
+        sock.send_multipart(frames, flags)
+        self.check(sock)
+
+    def _drain(self, fd):
+        sock, callback = self._handlers[fd]
+        for _ in range(self.max_batch):
+            if fd not in self._handlers:  # the callback unregistered it
+                return
+            if not sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                return
+            callback(sock, sock.recv_multipart(zmq.NOBLOCK))
+        self._recheck.add(fd)  # not drained yet, give the others a turn first
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) and dispatch what is ready, returns the number of wake-ups"""
+        if self._recheck:
+            timeout = 0  # these may have messages that won't trigger epoll any more
+        events = self._epoll.poll(-1 if timeout is None else timeout)
+        ready = self._recheck
+        self._recheck = set()
+        ready.update(fd for fd, _ in events)
+        for fd in ready:
+            if fd in self._handlers:
+                self._drain(fd)
+        return len(events)
+
+    def run(self, timeout=None):
+        """Dispatch until no socket is registered any more, an interrupted epoll_wait (EINTR) is left to the caller"""
+        while self._handlers:
+            self.poll(timeout)
+
+    def close(self):
+        self._epoll.close()
+        self._handlers.clear()
+        self._fds.clear()
+        self._recheck.clear()
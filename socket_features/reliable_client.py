@@ -0,0 +1,161 @@
+import itertools
+import logging
+import struct
+import time
+import zmq
+
+from socket_factory import SocketFactory
+
+
+log_client = logging.getLogger(name="RELIABLE")
+
+REQUEST_ID = struct.Struct("!Q")
+
+
+class LazyPirateClient(object):
+    """
+    Request/reply with a deadline per request, retries and a pool of connected REQ sockets (the Lazy Pirate pattern).
+
+    A REQ socket that never gets its reply is stuck: it can't send again and recv() blocks forever. Here the reply is
+    polled for `timeout` ms; if none comes the socket is closed (LINGER 0, the request is discarded) and the request
+    is retried on a fresh socket after a backoff doubling from `backoff` up to `max_backoff` seconds. With several
+    endpoints every retry goes to the next one. zmq.Again is raised when all `retries` are used up.
+
+    Healthy sockets go back to the pool of a SocketFactory (its own one unless `factory` is given), so a request
+    normally doesn't pay for a new socket and connection. The client can be shared by threads, each request checks
+    out its own socket.
+    """
+
+    OPTIONS = {zmq.LINGER: 0}
+
+    def __init__(self, context, endpoints, timeout=2500, retries=3, backoff=0.1, max_backoff=5.0, factory=None):
+        self.endpoints = [endpoints] if isinstance(endpoints, str) else list(endpoints)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._own_factory = factory is None
+        self.factory = SocketFactory(context) if factory is None else factory
+        self._next = itertools.count()
+
+    def warm_up(self, n=4):
+        """Connect n sockets per endpoint ahead of the first requests"""
+        for endpoint in self.endpoints:
+            self.factory.warm_up(zmq.REQ, endpoint, self.OPTIONS, n)
+
+    def request(self, frames, timeout=None, retries=None):
+        """Send a message (a string or a list of frames) and return the reply frames"""
+        frames = [frames] if isinstance(frames, bytes) else frames
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        first = next(self._next)
+        for attempt in range(retries + 1):
+            endpoint = self.endpoints[(first + attempt) % len(self.endpoints)]
+            socket = self.factory.checkout(zmq.REQ, endpoint, self.OPTIONS)
+            try:
+                socket.send_multipart(frames)
+                reply = socket.recv_multipart() if socket.poll(timeout) else None
+            except zmq.ZMQError:
+                self.factory.discard(socket)
+                raise
+            if reply is not None:
+                self.factory.checkin(socket)
+                return reply
+            self.factory.discard(socket)  # the REQ socket waits for a reply that may never come, don't reuse it
+            if attempt < retries:
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                log_client.warning("No reply from %s within %d ms, retrying in %.2fs", endpoint, timeout, delay)
+                time.sleep(delay)
+        raise zmq.Again("no reply after %d attempts" % (retries + 1))
+
+    def close(self):
+        if self._own_factory:
+            self.factory.close()
+
+
+class PipelinedClient(object):
+    """
+    Many requests in flight over a single DEALER socket, each with its own deadline and retries.
+
+    Every request is sent as [request id, "", frames...]. A REP server treats everything up to the empty frame as the
+    envelope and returns it with the reply, so replies can arrive in any order and are matched by id; so does a ROUTER
+    broker in between, it only adds its own envelope frame in front. A request without a reply within `timeout` ms is
+    sent again with the same id, up to `retries` times; a late reply to an earlier attempt answers it as well and the
+    duplicate is dropped. Unlike REQ the DEALER never gets stuck, so nothing is recreated. Not thread-safe.
+    """
+
+    def __init__(self, context, endpoints, timeout=2500, retries=3):
+        self.timeout = timeout
+        self.retries = retries
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        for endpoint in [endpoints] if isinstance(endpoints, str) else endpoints:
+            self.socket.connect(endpoint)
+        self._ids = itertools.count()
+        self.in_flight = {}  # request id -> [frames, deadline, attempts]
+
+    def send(self, frames):
+        """Send a request without waiting for the reply, returns its request id"""
+        frames = [frames] if isinstance(frames, bytes) else frames
+        request_id = REQUEST_ID.pack(next(self._ids))
+        self.in_flight[request_id] = [frames, 0, 0]
+        self._send(request_id)
+        return request_id
+
+    def _send(self, request_id):
+        request = self.in_flight[request_id]
+        request[1] = time.time() + self.timeout / 1000.0
+        request[2] += 1
+        self.socket.send_multipart([request_id, b""] + request[0])
+
+    def _expire(self):
+        """Retry the requests past their deadline, returns (request id, None) for those out of retries"""
+        now = time.time()
+        for request_id, (frames, deadline, attempts) in list(self.in_flight.items()):
+            if deadline > now:
+                continue
+            if attempts > self.retries:
+                del self.in_flight[request_id]
+                return request_id, None
+            log_client.warning("No reply to request %d, retrying", REQUEST_ID.unpack(request_id)[0])
+            self._send(request_id)
+        return None
+
+    def recv(self, timeout=None):
+        """
+        Wait up to timeout ms (None: until something happens) for the next reply and return (request id, reply frames).
+        A request that ran out of retries is returned as (request id, None). Raises zmq.Again on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout / 1000.0
+        while True:
+            failed = self._expire()
+            if failed is not None:
+                return failed
+            waits = [request[1] for request in self.in_flight.values()]
+            if deadline is not None:
+                waits.append(deadline)
+            if not self.socket.poll(max(int((min(waits) - time.time()) * 1000), 0) if waits else None):
+                if deadline is not None and time.time() >= deadline:
+                    raise zmq.Again()
+                continue
+            frames = self.socket.recv_multipart()
+            request_id, reply = frames[0], frames[2:]
+            if self.in_flight.pop(request_id, None) is not None:
+                return request_id, reply
+
+    def request_many(self, requests, max_in_flight=100):
+        """Send all requests with at most max_in_flight outstanding, returns the replies (None if failed) in order"""
+        requests = iter(requests)
+        order = []
+        replies = {}
+        for frames in itertools.islice(requests, max_in_flight):
+            order.append(self.send(frames))
+        while self.in_flight:
+            request_id, reply = self.recv()
+            replies[request_id] = reply
+            for frames in itertools.islice(requests, 1):
+                order.append(self.send(frames))
+        return [replies[request_id] for request_id in order]
+
+    def close(self):
+        self.socket.close()
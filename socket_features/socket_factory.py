@@ -0,0 +1,176 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+import zmq
+
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
+log_factory = logging.getLogger(name="FACTORY")
+
+
+class SocketFactory(object):
+    """
+    Pools connected sockets per (type, endpoint, options) on one shared context, Context.instance() by default.
+
+    Every context.socket() costs file descriptors and every connect a TCP connection (see context/context.py), and
+    closing it leaves the connection in TIME_WAIT. Code that needs a socket for a while checks one out, uses it and
+    checks it back in; the next checkout for the same key gets the same, already connected socket. A checked out
+    socket belongs to the thread that took it - zmq sockets are not thread-safe - and only that thread may check it
+    in. Sockets moving between threads pass through the pool lock, which is the memory barrier zmq requires.
+
+    A socket must be checked in in a usable state (e.g. a REQ socket not waiting for a reply), otherwise discard it.
+    Idle sockets unused for max_idle seconds are closed by reap(), which checkin() calls every reap_interval seconds.
+    Options are applied before connect; don't pool sockets with an IDENTITY option, the peers would see duplicates.
+    """
+
+    def __init__(self, context=None, max_idle=60.0, max_per_key=8, reap_interval=5.0):
+        self.context = context or zmq.Context.instance()
+        self.max_idle = max_idle
+        self.max_per_key = max_per_key
+        self.reap_interval = reap_interval
+        self._idle = collections.defaultdict(collections.deque)  # key -> (socket, checked in at), most recent last
+        self._leased = {}  # socket -> (key, thread ident)
+        self._lock = threading.Lock()
+        self._next_reap = time.time() + reap_interval
+
+    @staticmethod
+    def key(socket_type, endpoint, options=None):
+        return socket_type, endpoint, tuple(sorted((options or {}).items()))
+
+    def _create(self, key):
+        socket_type, endpoint, options = key
+        socket = self.context.socket(socket_type)
+        for option, value in options:
+            socket.setsockopt(option, value)
+        socket.connect(endpoint)
+        return socket
+
+    def checkout(self, socket_type, endpoint, options=None):
+        key = self.key(socket_type, endpoint, options)
+        socket = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                socket = idle.pop()[0]  # the most recently used one, its connection is the most likely to be alive
+        if socket is None:
+            socket = self._create(key)
+        with self._lock:
+            self._leased[socket] = (key, threading.current_thread().ident)
+        return socket
+
+    def _release(self, socket):
+        with self._lock:
+            key, owner = self._leased[socket]
+            if owner != threading.current_thread().ident:  # still leased, the owner can return it
+                raise ValueError("a socket can only be checked in by the thread that checked it out")
+            del self._leased[socket]
+        return key
+
+    def checkin(self, socket):
+        key = self._release(socket)
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.max_per_key:
+                idle.append((socket, time.time()))
+                socket = None
+        if socket is not None:
+            socket.close()
+        if time.time() >= self._next_reap:
+            self.reap()
+
+    def discard(self, socket, linger=0):
+        """Close a checked out socket instead of returning it, e.g. a REQ socket stuck waiting for a reply"""
+        self._release(socket)
+        socket.close(linger)
+
+    @contextlib.contextmanager
+    def socket(self, socket_type, endpoint, options=None):
+        """with factory.socket(zmq.REQ, endpoint) as sock: ... - discarded instead of returned if the block raises"""
+        socket = self.checkout(socket_type, endpoint, options)
+        try:
+            yield socket
+        except BaseException:
+            self.discard(socket)
+            raise
+        self.checkin(socket)
+
+    def warm_up(self, socket_type, endpoint, options=None, n=1):
+        """
+        Create and connect up to n idle sockets for the key ahead of time. The connections are established by the
+        I/O threads in the background, so they are usually ready by the first checkout.
+        """
+        key = self.key(socket_type, endpoint, options)
+        with self._lock:
+            missing = min(n, self.max_per_key) - len(self._idle[key])
+        sockets = [self._create(key) for _ in range(max(missing, 0))]
+        now = time.time()
+        with self._lock:
+            self._idle[key].extend((socket, now) for socket in sockets)
+
+    def reap(self):
+        """Close the sockets that were idle for longer than max_idle, returns how many"""
+        cutoff = time.time() - self.max_idle
+        expired = []
+        with self._lock:
+            self._next_reap = time.time() + self.reap_interval
+            for key, idle in list(self._idle.items()):
+                while idle and idle[0][1] < cutoff:
+                    expired.append(idle.popleft()[0])
+                if not idle:
+                    del self._idle[key]
+        for socket in expired:
+            socket.close()
+        if expired:
+            log_factory.debug("Reaped %d idle sockets", len(expired))
+        return len(expired)
+
+    def close(self, linger=None):
+        """Close the idle sockets; sockets still checked out stay with their threads"""
+        with self._lock:
+            idle, self._idle = self._idle, collections.defaultdict(collections.deque)
+            if self._leased:
+                log_factory.warning("Closing with %d sockets still checked out", len(self._leased))
+        for sockets in idle.values():
+            for socket, _ in sockets:
+                socket.close(linger)
+
+
+def main():
+    """
+    Many short requests from a few threads: each thread checks a REQ socket out per request, yet only one socket (and
+    TCP connection) per thread is ever created.
+    """
+    context = zmq.Context.instance()
+    endpoint = "tcp://127.0.0.1:5555"
+    server = context.socket(zmq.REP)
+    server.bind(endpoint)
+    factory = SocketFactory(context, max_idle=1.0, reap_interval=0.5)
+    factory.warm_up(zmq.REQ, endpoint, {zmq.LINGER: 0}, n=3)
+    n_threads, n_requests = 3, 100
+
+    def client():
+        for i in range(n_requests):
+            with factory.socket(zmq.REQ, endpoint, {zmq.LINGER: 0}) as sock:
+                sock.send(b"ping")
+                sock.recv()
+
+    threads = [threading.Thread(target=client) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for _ in range(n_threads * n_requests):
+        server.send(server.recv())
+    for thread in threads:
+        thread.join()
+    log_factory.info("%d requests over %d pooled sockets", n_threads * n_requests,
+                     sum(len(idle) for idle in factory._idle.values()))
+    time.sleep(1.5)
+    factory.reap()
+    factory.close()
+    server.close()
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
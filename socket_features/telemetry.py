@@ -0,0 +1,248 @@
+import collections
+import json
+import logging
+import threading
+import time
+import zmq
+from zmq.utils.monitor import recv_monitor_message
+
+
+log_telemetry = logging.getLogger(name="TELEMETRY")
+
+EVENT_NAMES = dict((getattr(zmq, name), name[len("EVENT_"):]) for name in dir(zmq)
+                   if name.startswith("EVENT_") and name not in ("EVENT_ALL",))
+
+
+def _endpoint_key(endpoint):
+    """bind("tcp://*:5555") and connect("tcp://127.0.0.1:5555") are the same endpoint"""
+    for host in ("*", "0.0.0.0", "localhost"):
+        endpoint = endpoint.replace("://%s:" % host, "://127.0.0.1:")
+    return endpoint
+
+
+class SocketStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.sends = 0
+        self.receives = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.eagain = 0  # Again on send or recv (NOBLOCK or timeouts)
+        self.mute_events = 0  # sends refused because the socket reached its HWM
+        self.mute = False
+        self.readable = None  # from zmq.EVENTS, only refreshed by InstrumentedSocket.sample()
+        self.writable = None
+        self.endpoints = []
+        self.events = collections.Counter()  # monitor events by name
+        self.peers = 0  # connected or accepted minus disconnected
+
+    def snapshot(self):
+        snapshot = dict(vars(self))
+        snapshot["events"] = dict(self.events)
+        snapshot["endpoints"] = list(self.endpoints)
+        return snapshot
+
+
+class InstrumentedSocket(object):
+    """
+    Wraps a zmq socket and counts what goes through it; everything not overridden is passed to the socket.
+
+    Only the thread owning the socket may use it, as with the socket itself. The counters are plain integers the
+    Telemetry thread reads without locking - a snapshot may be off by the message in flight, which is fine for
+    telemetry.
+    """
+
+    def __init__(self, socket, name, telemetry=None):
+        self.socket = socket
+        self.stats = SocketStats(name)
+        self.bound = []  # endpoints as given, e.g. to re-apply options that only take effect on new connections
+        self.connected = []
+        self._telemetry = telemetry
+        if telemetry is not None:
+            telemetry.add(self)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def bind(self, endpoint):
+        self.stats.endpoints.append(_endpoint_key(endpoint))
+        self.bound.append(endpoint)
+        return self.socket.bind(endpoint)
+
+    def connect(self, endpoint):
+        self.stats.endpoints.append(_endpoint_key(endpoint))
+        self.connected.append(endpoint)
+        return self.socket.connect(endpoint)
+
+    def _sent(self, n_bytes):
+        self.stats.sends += 1
+        self.stats.bytes_sent += n_bytes
+        self.stats.mute = False
+
+    def _refused(self):
+        self.stats.eagain += 1
+        self.stats.mute_events += 1
+        self.stats.mute = True
+
+    def send(self, data, flags=0, copy=True, track=False):
+        try:
+            result = self.socket.send(data, flags, copy=copy, track=track)
+        except zmq.Again:
+            self._refused()
+            raise
+        if not flags & zmq.SNDMORE:
+            self._sent(len(data))
+        return result
+
+    def send_multipart(self, msg_parts, flags=0, copy=True, track=False):
+        try:
+            result = self.socket.send_multipart(msg_parts, flags, copy=copy, track=track)
+        except zmq.Again:
+            self._refused()
+            raise
+        self._sent(sum(len(part) for part in msg_parts))
+        return result
+
+    def _received(self, n_bytes):
+        self.stats.receives += 1
+        self.stats.bytes_received += n_bytes
+
+    def recv(self, flags=0, copy=True, track=False):
+        try:
+            msg = self.socket.recv(flags, copy=copy, track=track)
+        except zmq.Again:
+            self.stats.eagain += 1
+            raise
+        self._received(len(msg) if copy else len(msg.buffer))
+        return msg
+
+    def recv_multipart(self, flags=0, copy=True, track=False):
+        try:
+            msg = self.socket.recv_multipart(flags, copy=copy, track=track)
+        except zmq.Again:
+            self.stats.eagain += 1
+            raise
+        self._received(sum(len(part) if copy else len(part.buffer) for part in msg))
+        return msg
+
+    def sample(self):
+        """Refresh the readable/writable flags from zmq.EVENTS (call it from the owning thread)"""
+        events = self.socket.getsockopt(zmq.EVENTS)
+        self.stats.readable = bool(events & zmq.POLLIN)
+        self.stats.writable = bool(events & zmq.POLLOUT)
+
+    def close(self, linger=None):
+        if self._telemetry is not None:
+            self._telemetry.remove(self)
+        self.socket.close(linger)
+
+
+class Telemetry(object):
+    """
+    Collects the stats of InstrumentedSockets and their connection events and exports a snapshot every interval.
+
+    Each added socket gets a monitor socket (get_monitor_socket()) which only the collector thread reads. The
+    snapshot also estimates, per endpoint, the messages in flight: sent minus received by all instrumented sockets
+    on that endpoint. Together with the mute flags and the readable flag of the receiver (see sample()) this tells
+    whether messages are held back in the sender (mute), sitting in the receiver's queue (readable) or somewhere in
+    between - the connection pipes and the kernel.
+    """
+
+    def __init__(self, interval=1.0, sink=None):
+        self.interval = interval
+        self.sink = sink or self._log_snapshot
+        self._sockets = {}  # monitor socket -> InstrumentedSocket
+        self._closing = []  # monitors of removed sockets, closed by the collector thread which owns them
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, instrumented):
+        monitor = instrumented.socket.get_monitor_socket()
+        with self._lock:
+            self._sockets[monitor] = instrumented
+
+    def remove(self, instrumented):
+        with self._lock:
+            for monitor, sock in list(self._sockets.items()):
+                if sock is instrumented:
+                    del self._sockets[monitor]
+                    self._disable_monitor(sock.socket)
+                    self._closing.append(monitor)
+
+    @staticmethod
+    def _disable_monitor(socket):
+        if socket.closed:
+            return
+        try:
+            socket.disable_monitor()
+        except zmq.ContextTerminated:
+            pass
+        except zmq.ZMQError as e:
+            if e.errno != zmq.ENOTSOCK:  # the context was destroyed under us, e.g. from a signal handler
+                raise
+
+    def _close_monitors(self, monitors):
+        for monitor in monitors:
+            monitor.close(linger=0)
+
+    def _read_events(self, timeout):
+        with self._lock:
+            closing, self._closing = self._closing, []
+            monitors = list(self._sockets)
+        self._close_monitors(closing)
+        if not monitors:
+            self._stop.wait(timeout / 1000.0)
+            return
+        poller = zmq.Poller()
+        for monitor in monitors:
+            poller.register(monitor, zmq.POLLIN)
+        for monitor, _ in poller.poll(timeout):
+            with self._lock:
+                sock = self._sockets.get(monitor)
+                if sock is None:
+                    continue
+                event = recv_monitor_message(monitor)
+            name = EVENT_NAMES.get(event["event"], str(event["event"]))
+            sock.stats.events[name] += 1
+            if name in ("CONNECTED", "ACCEPTED"):
+                sock.stats.peers += 1
+            elif name == "DISCONNECTED":
+                sock.stats.peers -= 1
+
+    def snapshot(self):
+        with self._lock:
+            sockets = [sock.stats.snapshot() for sock in self._sockets.values()]
+        in_flight = collections.Counter()
+        for stats in sockets:
+            for endpoint in stats["endpoints"]:
+                in_flight[endpoint] += stats["sends"] - stats["receives"]
+        return {"time": time.time(), "sockets": sockets, "in_flight": dict(in_flight)}
+
+    def _log_snapshot(self, snapshot):
+        log_telemetry.info("%s", json.dumps(snapshot, sort_keys=True))
+
+    def _run(self):
+        next_export = time.time() + self.interval
+        try:
+            while not self._stop.is_set():
+                self._read_events(max(int((next_export - time.time()) * 1000), 0))
+                if time.time() >= next_export:
+                    self.sink(self.snapshot())
+                    next_export += self.interval
+        except zmq.ZMQError:  # the context was destroyed under us
+            log_telemetry.info("Context gone, stopped collecting events")
+        with self._lock:
+            monitors, self._closing = self._closing + list(self._sockets), []
+        self._close_monitors(monitors)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="Telemetry")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sink(self.snapshot())
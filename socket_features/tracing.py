@@ -0,0 +1,138 @@
+import json
+import logging
+import struct
+import threading
+import time
+
+from histogram import Histogram
+
+
+log_tracing = logging.getLogger(name="TRACING")
+
+clock = getattr(time, "monotonic", time.time)  # python 2 has no monotonic clock, wall clock it is
+
+MAGIC = b"\x00TRC"  # a trace frame starts with it, a payload shouldn't
+HOP = struct.Struct("!Bd")  # hop, timestamp in seconds
+
+CLIENT_SEND = 1
+BROKER_IN = 2
+BROKER_OUT = 3
+WORKER_IN = 4
+WORKER_OUT = 5
+BROKER_REPLY = 6
+CLIENT_RECV = 7
+HOP_NAMES = {
+    CLIENT_SEND: "client_send",
+    BROKER_IN: "broker_in",
+    BROKER_OUT: "broker_out",
+    WORKER_IN: "worker_in",
+    WORKER_OUT: "worker_out",
+    BROKER_REPLY: "broker_reply",
+    CLIENT_RECV: "client_recv",
+}
+
+
+def start_trace(hop=CLIENT_SEND):
+    """A new trace frame, to be put in front of the message body"""
+    return MAGIC + HOP.pack(hop, clock())
+
+
+def is_trace(frame):
+    return frame[:len(MAGIC)] == MAGIC
+
+
+def stamp(trace, hop):
+    return trace + HOP.pack(hop, clock())
+
+
+def stamped(frames, index, hop):
+    """
+    frames with the trace frame at `index` stamped with hop, as a new list. Messages without a trace frame there are
+    returned as they are, so traced and plain messages can share the path and an untraced one costs a compare.
+    """
+    if len(frames) <= index or not is_trace(frames[index]):
+        return frames
+    frames = list(frames)
+    frames[index] = stamp(frames[index], hop)
+    return frames
+
+
+def split_trace(frames):
+    """(trace frame, body frames) of a message; the trace is None if the message has none"""
+    if frames and is_trace(frames[0]):
+        return frames[0], frames[1:]
+    return None, frames
+
+
+def hops(trace):
+    """The (hop, timestamp) pairs recorded in a trace frame, in order"""
+    return [HOP.unpack_from(trace, offset) for offset in range(len(MAGIC), len(trace), HOP.size)]
+
+
+class TraceCollector(object):
+    """
+    Aggregates finished traces into one latency histogram per hop-to-hop segment and exports them every interval.
+
+    A trace through multithreaded_proxy gives e.g.
+
+        client_send->broker_in     transport into the broker and waiting in its clients socket: the broker only
+                                   reads a request once a worker has credit, so under load this is mostly queueing
+        broker_in->broker_out      the broker's own hand-off from the clients to the workers socket
+        broker_out->worker_in      inproc/ipc hand-off to the worker, and its queue
+        worker_in->worker_out      the work itself
+        worker_out->broker_reply, broker_reply->client_recv    the way back
+
+    plus "total". Each export covers the traces since the previous one (the histograms start over), so a change in
+    where the time goes shows up in the next snapshot. record() may be called from any thread. The timestamps come
+    from the monotonic clock of the host: hops in other processes are fine, hops on other hosts are not comparable.
+    """
+
+    def __init__(self, interval=1.0, sink=None):
+        self.interval = interval
+        self.sink = sink or self._log_snapshot
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, trace):
+        timeline = hops(trace)
+        if len(timeline) < 2:
+            return
+        segments = [("%s->%s" % (HOP_NAMES.get(hop, hop), HOP_NAMES.get(next_hop, next_hop)), (end - start) * 1e6)
+                    for (hop, start), (next_hop, end) in zip(timeline, timeline[1:])]
+        segments.append(("total", (timeline[-1][1] - timeline[0][1]) * 1e6))
+        with self._lock:
+            for name, latency in segments:
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    histogram = self._histograms[name] = Histogram(precision=5)  # ~3%, plenty per hop
+                histogram.record(latency)
+
+    def snapshot(self, reset=True):
+        with self._lock:
+            histograms = self._histograms
+            if reset:
+                self._histograms = {}
+        return {"time": time.time(), "unit": "us",
+                "segments": dict((name, histogram.summary()) for name, histogram in histograms.items())}
+
+    def _log_snapshot(self, snapshot):
+        if snapshot["segments"]:
+            log_tracing.info("%s", json.dumps(snapshot, sort_keys=True))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sink(self.snapshot())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="Trace-collector")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop exporting, the traces since the last export go out once more"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sink(self.snapshot())
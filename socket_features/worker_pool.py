@@ -0,0 +1,91 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import zmq
+
+
+log_pool = logging.getLogger(name="POOL")
+
+
+def _run_in_process(target, worker_id, worker_url, credit, stop):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ctrl-c goes to the parent, which drains the pool
+    context = zmq.Context()  # a context must never be shared with a forked child
+    try:
+        target(worker_id, context, worker_url, credit, stop)
+    finally:
+        context.destroy(linger=1000)
+
+
+class WorkerPool(object):
+    """
+    Runs `size` workers with the multithreaded_proxy.worker_routine contract:
+
+        target(worker_id, context, worker_url, credit, stop)
+
+    where `stop` is an event the worker checks while idle. Threads share the given context and may use inproc://;
+    processes each create their own context, so they need an ipc:// (or tcp://) url, but CPU-bound handlers no longer
+    serialise on the GIL. Workers that die are restarted with the same id, and stop() lets them finish what they
+    already hold before joining them.
+    """
+
+    def __init__(self, target, worker_url, mode="thread", size=None, credit=1, context=None, check_interval=1.0):
+        if mode not in ("thread", "process"):
+            raise ValueError("unknown worker mode: %s" % mode)
+        if mode == "process" and worker_url.startswith("inproc://"):
+            raise ValueError("process workers can't connect to %s, use ipc://" % worker_url)
+        self.target = target
+        self.worker_url = worker_url
+        self.mode = mode
+        self.size = size or multiprocessing.cpu_count()
+        self.credit = credit
+        self._context = context or zmq.Context.instance()
+        self._check_interval = check_interval
+        self._workers = {}
+        self._stop = threading.Event() if mode == "thread" else multiprocessing.Event()
+        self._stopping = threading.Event()
+        self._supervisor = None
+
+    def _spawn(self, worker_id):
+        if self.mode == "thread":
+            worker = threading.Thread(target=self.target,
+                                      args=(worker_id, self._context, self.worker_url, self.credit, self._stop),
+                                      name="Worker-%d" % worker_id)
+        else:
+            worker = multiprocessing.Process(target=_run_in_process,
+                                             args=(self.target, worker_id, self.worker_url, self.credit, self._stop),
+                                             name="Worker-%d" % worker_id)
+        worker.daemon = True
+        worker.start()
+        self._workers[worker_id] = worker
+
+    def _supervise(self):
+        while not self._stopping.wait(self._check_interval):
+            for worker_id, worker in list(self._workers.items()):
+                if not worker.is_alive() and not self._stopping.is_set():
+                    log_pool.warn("Worker %d died (exit code %s), restarting", worker_id,
+                                  getattr(worker, "exitcode", None))
+                    self._spawn(worker_id)
+
+    def start(self):
+        for worker_id in range(self.size):
+            self._spawn(worker_id)
+        self._supervisor = threading.Thread(target=self._supervise, name="Pool-supervisor")
+        self._supervisor.daemon = True
+        self._supervisor.start()
+        log_pool.info("Started %d %s workers on %s", self.size, self.mode, self.worker_url)
+
+    def stop(self, timeout=10.0):
+        """Let the workers drain, wait up to timeout for each of them and kill processes that hang"""
+        self._stopping.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+        self._stop.set()
+        for worker_id, worker in self._workers.items():
+            worker.join(timeout)
+            if worker.is_alive():
+                log_pool.warn("Worker %d didn't drain in %.1fs", worker_id, timeout)
+                if self.mode == "process":
+                    worker.terminate()
+                    worker.join()
+        self._workers.clear()
@@ -0,0 +1,4 @@
+"""
+Socket type experiments. Those importing from socket_features run as modules from the repo root, e.g.
+python -m socket_types.zmq_experiments
+"""
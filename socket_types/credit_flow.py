@@ -0,0 +1,99 @@
+import collections
+import struct
+import zmq
+
+
+CREDIT = b"CREDIT"
+COUNT = struct.Struct("!I")
+
+
+class CreditSender(object):
+    """
+    Sending side of credit-based flow control (the credit pattern of the ZeroMQ guide).
+
+    Receivers grant credit with [CREDIT, n] messages and the sender never has more messages outstanding than it was
+    granted, so the queues stay bounded by the receivers' windows on any transport and no HWM or sleep is needed to
+    pace the sender. On a ROUTER the credit is tracked per receiver and send() picks the receiver with the most credit
+    left, so no receiver ever has more than its window in flight. On a DEALER the credit of all receivers is pooled
+    and the DEALER's round-robin picks the receiver: only the total in flight is bounded (by the sum of the windows),
+    a slow receiver may be sent more than its own window while the fast ones keep granting. Use a ROUTER when the
+    window has to hold per receiver.
+
+    Credit and replies of the receivers share the socket: anything that isn't a grant is kept for recv().
+    """
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.per_peer = socket.getsockopt(zmq.TYPE) == zmq.ROUTER
+        self.credit = {}  # receiver identity (None for a DEALER) -> messages it may still be sent
+        self.inbox = collections.deque()  # messages of the receivers that aren't credit, as received
+
+    def _grant(self, frames):
+        if self.per_peer:
+            peer, message = frames[0], frames[1:]
+        else:
+            peer, message = None, frames
+        if len(message) == 2 and message[0] == CREDIT:
+            self.credit[peer] = self.credit.get(peer, 0) + COUNT.unpack(message[1])[0]
+        else:
+            self.inbox.append(frames)
+
+    def process_credit(self, timeout=0):
+        """Take in the granted credit, waiting up to timeout ms (None waits forever) for the first grant"""
+        if not self.socket.poll(timeout):
+            return
+        while self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            self._grant(self.socket.recv_multipart(zmq.NOBLOCK))
+
+    def recv(self, timeout=None):
+        """
+        The next message of a receiver that isn't credit (with the identity frame first on a ROUTER), waiting up to
+        timeout ms (None waits forever). Raises zmq.Again if none came in time.
+        """
+        self.process_credit()
+        while not self.inbox:
+            if not self.socket.poll(timeout):
+                raise zmq.Again()
+            self.process_credit()
+        return self.inbox.popleft()
+
+    def send(self, frames, timeout=None):
+        """
+        Send one message as soon as there is credit for it, waiting up to timeout ms (None waits forever).
+        Returns the receiver it went to (None on a DEALER), raises zmq.Again if no credit came in time.
+        """
+        self.process_credit()
+        while not any(self.credit.values()):
+            if not self.socket.poll(timeout):
+                raise zmq.Again()
+            self.process_credit()
+        peer = max(self.credit, key=self.credit.get)
+        self.credit[peer] -= 1
+        self.socket.send_multipart(frames if peer is None else [peer] + frames)
+        return peer
+
+
+class CreditReceiver(object):
+    """
+    Receiving side, on a DEALER: grants `window` messages up front and then gives credit back in batches of
+    window/2 as messages are consumed. With the sender on a ROUTER at most `window` messages are ever queued towards
+    this receiver; a sender on a DEALER pools the credit and only bounds the total over all its receivers.
+    """
+
+    def __init__(self, socket, window=10):
+        self.socket = socket
+        self.window = window
+        self._batch = max(window // 2, 1)
+        self._consumed = 0
+        self._grant(window)
+
+    def _grant(self, n):
+        self.socket.send_multipart([CREDIT, COUNT.pack(n)])
+
+    def recv(self, flags=0):
+        frames = self.socket.recv_multipart(flags)
+        self._consumed += 1
+        if self._consumed == self._batch:
+            self._grant(self._consumed)
+            self._consumed = 0
+        return frames
@@ -1,92 +1,112 @@
 import logging
 import threading
-import time
 import zmq
 
+from socket_features.endpoints import EndpointRegistry
+from state_sync import StatePublisher, StateSubscriber
+
 
 logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
 log_pub = logging.getLogger(name="PUBLISHER")
 log_sub = logging.getLogger(name="SUBSCRIBER")
 log_common = logging.getLogger(name="Helper")
 
+registry = EndpointRegistry()
 
-def create_sub(context, publisher_url, topic_name, publisher_sync_url, total_msgs):
-    subscriber = context.socket(zmq.SUB)
-    subscriber.setsockopt(zmq.SUBSCRIBE, topic_name)
-    subscriber.connect(publisher_url)
-    sub_id = threading.current_thread().name
-
-    publisher_notify = context.socket(zmq.REQ)
-    publisher_notify.connect(publisher_sync_url)
-    publisher_notify.send(sub_id)
-    publisher_notify.recv()
 
-    received_msgs = 0
+def create_sub(context, topic_name, end_topic):
+    sub_id = threading.current_thread().name
+    publisher_url = registry.resolve("updates", context, timeout=10)
+    snapshot_url = registry.resolve("snapshots", context, timeout=10)
+    log_sub.info("%s connects to %s and %s", sub_id, publisher_url, snapshot_url)
+    subscriber = StateSubscriber(context, publisher_url, snapshot_url, topic_name)
 
     while True:
-        try:
-            msg = subscriber.recv_multipart()
-            log_sub.info("%s got: %s", sub_id, msg)
-            received_msgs += 1
-            if received_msgs >= total_msgs:
-                subscriber.close()
-                publisher_notify.send(sub_id)
-                publisher_notify.recv()
-                publisher_notify.close()
-                break
-        except zmq.ZMQError:  # closing the publisher socket causes the subscribers to throw an exception in recv()
-            subscriber.close()
+        topic, seq, value = subscriber.recv()
+        log_sub.info("%s got: %s #%d: %.64s", sub_id, topic, seq, value)  # long values are cut
+        if topic == end_topic:
             break
-
-
-def sync_with_subs(sync_sock, n_subs):
-    for i in range(n_subs):
-        sync_msg = sync_sock.recv()
-        log_pub.info("Recv sync: %s", sync_msg)
-        sync_sock.send("ack")
+    subscriber.close()
+
+
+def test_snapshot_beyond_hwm(transport="inproc", n_topics=5000):
+    """
+    A snapshot of more topics than the snapshot pipe holds (SNDHWM + RCVHWM, 2000 by default) must arrive whole:
+    the publisher waits for room instead of the ROUTER dropping the overflow - the END marker included.
+    """
+    log_common.info("Testing a snapshot of %d topics over %s", n_topics, transport)
+    context = zmq.Context()
+    if transport == "inproc":
+        endpoint, snapshot_endpoint = "inproc://updates", "inproc://snapshots"
+        bind_endpoint, bind_snapshot_endpoint = endpoint, snapshot_endpoint
+    else:
+        endpoint, snapshot_endpoint = "tcp://127.0.0.1:5557", "tcp://127.0.0.1:5558"
+        bind_endpoint, bind_snapshot_endpoint = "tcp://*:5557", "tcp://*:5558"
+    publisher = StatePublisher(context, bind_endpoint, bind_snapshot_endpoint)
+    for i in range(n_topics):
+        publisher.publish("T-%05d" % i, "value %d" % i)
+    received = []
+
+    def subscribe():
+        subscriber = StateSubscriber(context, endpoint, snapshot_endpoint, "T-")
+        received.append(len(subscriber.state))
+        subscriber.close()
+
+    th = threading.Thread(target=subscribe)
+    th.start()
+    while th.is_alive():
+        publisher.serve_snapshots(timeout=100)
+    th.join()
+    publisher.close()
+    context.term()
+    assert received == [n_topics], "snapshot incomplete: %s of %d topics" % (received, n_topics)
+    log_common.info("Got all %d topics", n_topics)
 
 
 def main():
+    """
+    Subscribers join at any time: a late one gets the current value of every topic from the snapshot and continues
+    with the deltas, so nothing is lost and the publisher never waits for anybody.
+
+    The endpoints come from the registry: the subscriber threads share the context and connect over inproc://,
+    other processes find the publisher over ipc:// or on ports 5555/5556.
+    """
     context = zmq.Context.instance()
-    publisher = context.socket(zmq.PUB)
-    publisher.bind("tcp://*:5555")
-    publisher_sync = context.socket(zmq.REP)
-    publisher_sync.bind("tcp://*:5556")
-    msg = ['A', 'This message will be lost']
-    publisher.send_multipart(msg)
+    publisher = StatePublisher(context)
+    registry.bind(publisher.publisher.socket, "updates", context, tcp_port=5555)
+    registry.bind(publisher.snapshots, "snapshots", context, tcp_port=5556)
+    msg = ['A', 'Published before any subscriber, delivered with the snapshot']
+    publisher.publish(*msg)
     log_pub.info("Sent: %s", msg)
 
-    time.sleep(0.5)
-
     N_SUBS = 2
+    N_UPDATES = 20
     subscriber_threads = []
 
-    for i in range(N_SUBS):
-        th = threading.Thread(target=create_sub, args=(context, "tcp://127.0.0.1:5555", "A", "tcp://127.0.0.1:5556", 2), name="Sub-%d" % (i+1))
-        subscriber_threads.append(th)
-        th.start()
-
-    sync_with_subs(publisher_sync, N_SUBS)
-
-    msg = ['B', 'This message is filtered out']
-    publisher.send_multipart(msg)
-    log_pub.info("Sent: %s", msg)
-    msg = ['A', 'This message should be received by all subscribers']
-    publisher.send_multipart(msg)
-    log_pub.info("Sent: %s", msg)
-    msg = 'A message that also should be received by all subscribers'
-    publisher.send(msg)  # matches by prefix
-    log_pub.info("Sent: %s", msg)
-
-    sync_with_subs(publisher_sync, N_SUBS)
-
+    for i in range(N_UPDATES):
+        if i % (N_UPDATES // N_SUBS) == 0:  # the subscribers join while updates are going on
+            th = threading.Thread(target=create_sub, args=(context, "A", "A-end"),
+                                  name="Sub-%d" % (len(subscriber_threads)+1))
+            subscriber_threads.append(th)
+            th.start()
+        publisher.publish('B', 'This message is filtered out')
+        publisher.publish('A', 'Update %d' % i)
+        publisher.serve_snapshots(timeout=10)
+    publisher.publish('A-end', 'Last update')  # matches by prefix
+
+    while any(th.is_alive() for th in subscriber_threads):
+        publisher.serve_snapshots(timeout=100)
+
+    registry.unregister("updates")
+    registry.unregister("snapshots")
     publisher.close()
-    publisher_sync.close()
     log_pub.info("Closed publisher sockets")
     context.term()
     log_common.info("Terminated the context")
     [th.join() for th in subscriber_threads]
     log_common.info("All sockets were closed")
+    test_snapshot_beyond_hwm("inproc")
+    test_snapshot_beyond_hwm("tcp")
 
 if __name__ == "__main__":
     main()
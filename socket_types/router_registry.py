@@ -0,0 +1,149 @@
+import collections
+import time
+import zmq
+
+
+class RouterRegistry(object):
+    """
+    Per-identity outbound queues for a ROUTER, so nothing is lost to peers that haven't connected yet.
+
+    A plain ROUTER silently drops messages for an identity it doesn't know (yet). With ROUTER_MANDATORY set the send
+    fails with EHOSTUNREACH instead, and the registry keeps the message in the identity's queue. The queue is flushed
+    in bulk as soon as the peer shows up:
+    - with ROUTER_NOTIFY (libzmq 4.3) the ROUTER reports [identity, ""] on every connect and disconnect, so the flush
+      is a dict lookup
+    - otherwise socket monitor events tell that some peer (dis)connected; the pending identities are retried on each
+      of them and on every process_events() call
+    A message received from an identity also proves it is connected. All lookups are dicts/sets, O(1) per message
+    even with tens of thousands of peers. Use recv() of the registry, not of the socket, so notifications are
+    consumed here; a peer sending an empty single-frame message would be taken for a notification.
+    """
+
+    def __init__(self, router, max_queued=10000):
+        self.router = router
+        self.max_queued = max_queued
+        self.connected = set()
+        self.queued = {}  # identity -> deque of messages waiting for the peer
+        self._received = collections.deque()  # peer messages that arrived while waiting in wait_flushed()
+        router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.monitor = None
+        try:
+            router.setsockopt(zmq.ROUTER_NOTIFY, zmq.NOTIFY_CONNECT | zmq.NOTIFY_DISCONNECT)
+            self.notify = True
+        except (AttributeError, zmq.ZMQError):  # older pyzmq/libzmq
+            self.notify = False
+            self.monitor = router.get_monitor_socket()
+            self._poller = zmq.Poller()
+            self._poller.register(router, zmq.POLLIN)
+            self._poller.register(self.monitor, zmq.POLLIN)
+
+    def send(self, identity, frames):
+        """Send frames to identity now or as soon as it connects. Returns True if it went out right away"""
+        queue = self.queued.get(identity)
+        if queue is not None:  # keep the order behind what is already waiting
+            self._queue(queue, frames)
+            return False
+        try:
+            self.router.send_multipart([identity] + frames)
+            return True
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EHOSTUNREACH:
+                raise
+        self.connected.discard(identity)
+        queue = self.queued[identity] = collections.deque()
+        self._queue(queue, frames)
+        return False
+
+    def _queue(self, queue, frames):
+        if len(queue) >= self.max_queued:
+            raise zmq.Again("too many messages queued for a peer that isn't connected")
+        queue.append(frames)
+
+    def flush(self, identity):
+        """Send what is queued for identity, returns the number of messages sent"""
+        queue = self.queued.get(identity)
+        sent = 0
+        while queue:
+            try:
+                self.router.send_multipart([identity] + queue[0])
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                return sent
+            queue.popleft()
+            sent += 1
+        self.queued.pop(identity, None)
+        return sent
+
+    def _peer_connected(self, identity):
+        if identity not in self.connected:
+            self.connected.add(identity)
+            self.flush(identity)
+
+    def process_events(self):
+        """Without ROUTER_NOTIFY: read monitor events and retry the pending identities, never blocks"""
+        if self.monitor is None:
+            return
+        while self.monitor.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            self.monitor.recv_multipart()
+        for identity in list(self.queued):
+            self.flush(identity)
+
+    def recv(self, flags=0):
+        """Receive the next message from a peer as [identity, frames...], handling the connect notifications"""
+        if self._received:
+            return self._received.popleft()
+        return self._recv(flags)
+
+    def _recv(self, flags):
+        while True:
+            self.process_events()
+            frames = self.router.recv_multipart(flags)
+            identity = frames[0]
+            if self.notify and frames[1:] == [b""]:
+                if identity in self.connected:
+                    self.connected.discard(identity)
+                else:
+                    self._peer_connected(identity)
+                continue
+            self._peer_connected(identity)
+            return frames
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout ms (None waits forever) for a message or notification on the router, retrying the pending
+        identities in the meantime. Returns 0 only once the timeout ran out, monitor events alone don't end the wait.
+        """
+        if self.monitor is None:
+            return self.router.poll(timeout)
+        deadline = None if timeout is None else time.time() + timeout / 1000.0
+        while True:
+            wait = None if deadline is None else int(max(deadline - time.time(), 0) * 1000)
+            if self.queued:  # the handshake may finish after the monitor event, keep retrying
+                wait = 10 if wait is None else min(wait, 10)
+            ready = dict(self._poller.poll(wait))
+            self.process_events()
+            if self.router in ready:
+                return ready[self.router]
+            if deadline is not None and time.time() >= deadline:
+                return 0
+
+    def wait_flushed(self, timeout=None):
+        """Process connects until every queued message went out, False if that took longer than timeout ms"""
+        deadline = None if timeout is None else time.time() + timeout / 1000.0
+        while self.queued:
+            remaining = None if deadline is None else int(max(deadline - time.time(), 0) * 1000)
+            if remaining == 0:
+                return False
+            if not self.poll(10 if remaining is None else min(remaining, 10)):  # short, a flush ends the wait too
+                continue
+            try:
+                self._received.append(self._recv(zmq.NOBLOCK))
+            except zmq.Again:
+                pass
+        return True
+
+    def close(self):
+        if self.monitor is not None:
+            self.router.disable_monitor()
+            self.monitor.close()
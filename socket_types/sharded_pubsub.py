@@ -0,0 +1,182 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+import zlib
+import zmq
+
+from topic_index import TopicPublisher
+
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(asctime)s: %(levelname)s: %(message)s")
+log_pub = logging.getLogger(name="PUBLISHER")
+log_sub = logging.getLogger(name="SUBSCRIBER")
+
+
+class ShardMap(object):
+    """
+    Which shard owns a topic: the topic is hashed over the shard endpoints, by default all of it, so topics sharing
+    a prefix ("A", "A-end", "ABC") still spread over the shards.
+
+    Subscriptions are prefixes, so with whole topics hashed any prefix may match topics of every shard and a
+    subscriber connects to all of them. Given key_length only the first key_length characters are hashed: a prefix
+    at least that long is then owned by exactly one shard, while a shorter one (e.g. "" for everything) still needs
+    all of them - worth it when the topics are namespaced by a fixed-length key. The hash (crc32) is the same in
+    every process, publishers and subscribers only have to agree on the endpoints and key_length.
+    """
+
+    def __init__(self, endpoints, key_length=None):
+        self.endpoints = list(endpoints)
+        self.key_length = key_length
+
+    def shard(self, topic):
+        key = topic if self.key_length is None else topic[:self.key_length]
+        return (zlib.crc32(key) & 0xffffffff) % len(self.endpoints)
+
+    def shards_for(self, prefix):
+        if self.key_length is not None and len(prefix) >= self.key_length:
+            return [self.shard(prefix)]
+        return list(range(len(self.endpoints)))
+
+
+def _run_shard(index, feed_endpoint, endpoint, stop):
+    """One shard process: publishes what the feed hands it, matching and copying for its own subscribers"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ctrl-c goes to the parent, which stops the shards
+    context = zmq.Context()  # a context must never be shared with a forked child
+    feed = context.socket(zmq.PULL)
+    feed.bind(feed_endpoint)
+    publisher = TopicPublisher(context, endpoint)
+    poller = zmq.Poller()
+    poller.register(feed, zmq.POLLIN)
+    poller.register(publisher.socket, zmq.POLLIN)
+    try:
+        while True:
+            events = dict(poller.poll(100))
+            if publisher.socket in events:
+                publisher.process_subscriptions()
+            if feed not in events:
+                if stop.is_set():
+                    break  # the feed is drained
+                continue
+            frames = feed.recv_multipart()
+            publisher.publish(frames[0], frames[1:])
+    finally:
+        log_pub.info("Shard %d on %s: sent %d, skipped %d", index, endpoint, publisher.sent, publisher.skipped)
+        feed.close()
+        publisher.close()
+        context.destroy(linger=1000)
+
+
+class ShardedPublisher(object):
+    """
+    Publishes through K shard processes, each binding its own endpoint of the ShardMap.
+
+    A single PUB socket does the subscription matching and queues a copy per subscriber in the publishing thread, so
+    it saturates one core. Here publish() only hashes the topic and hands the message to the owning shard over an
+    ipc PUSH/PULL feed - one message no matter how many subscribers - and the shards do the fan-out in parallel,
+    each skipping topics nobody subscribed to (TopicPublisher). Messages of one topic always go through the same
+    shard, so their order is kept. Like with any PUB, messages published before a subscriber connected are lost.
+    """
+
+    def __init__(self, shard_map, bind_endpoints=None, feed_url="ipc:///tmp/pubsub-feed-%d", context=None):
+        self.shard_map = shard_map
+        self.context = context or zmq.Context.instance()
+        self._stop = multiprocessing.Event()
+        self._shards = []
+        self.feeds = []
+        for index, endpoint in enumerate(bind_endpoints or shard_map.endpoints):
+            shard = multiprocessing.Process(target=_run_shard, args=(index, feed_url % index, endpoint, self._stop),
+                                            name="Shard-%d" % index)
+            shard.daemon = True
+            shard.start()
+            self._shards.append(shard)
+            feed = self.context.socket(zmq.PUSH)
+            feed.connect(feed_url % index)
+            self.feeds.append(feed)
+
+    def publish(self, topic, payload=None):
+        """Send [topic] + payload (a list of frames or a single frame) through the shard owning topic"""
+        if payload is None:
+            frames = [topic]
+        elif isinstance(payload, list):
+            frames = [topic] + payload
+        else:
+            frames = [topic, payload]
+        self.feeds[self.shard_map.shard(topic)].send_multipart(frames)
+
+    def close(self, timeout=10.0):
+        """Deliver what is queued to the shards, let them drain and stop them, killing those that hang"""
+        for feed in self.feeds:
+            feed.close(linger=int(timeout * 1000))
+        self._stop.set()
+        for index, shard in enumerate(self._shards):
+            shard.join(timeout)
+            if shard.is_alive():
+                log_pub.warning("Shard %d didn't stop in %.1fs", index, timeout)
+                shard.terminate()
+                shard.join()
+
+
+class ShardedSubscriber(object):
+    """A SUB socket connected only to the shards owning its prefixes"""
+
+    def __init__(self, context, shard_map, prefixes=()):
+        self.shard_map = shard_map
+        self.socket = context.socket(zmq.SUB)
+        self.connected = set()
+        for prefix in prefixes:
+            self.subscribe(prefix)
+
+    def subscribe(self, prefix):
+        self.socket.setsockopt(zmq.SUBSCRIBE, prefix)
+        for index in self.shard_map.shards_for(prefix):
+            if index not in self.connected:
+                self.socket.connect(self.shard_map.endpoints[index])
+                self.connected.add(index)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def close(self):
+        self.socket.close()
+
+
+def main():
+    """
+    4 shards, topics A..H sharded by their first character (key_length=1): the subscriber of "C" connects to one
+    shard, the one of "" to all of them and gets every topic, in order per topic.
+    """
+    context = zmq.Context.instance()
+    shard_map = ShardMap(["tcp://127.0.0.1:%d" % port for port in range(5560, 5564)], key_length=1)
+    publisher = ShardedPublisher(shard_map, context=context)
+    topics = [chr(ord("A") + i) for i in range(8)]
+    N_UPDATES = 100
+
+    def subscriber(prefix):
+        sub = ShardedSubscriber(context, shard_map, [prefix])
+        log_sub.info("%r connected to shards %s", prefix, sorted(sub.connected))
+        received = dict((topic, 0) for topic in topics)
+        while sub.poll(2000):
+            topic, update = sub.recv_multipart()
+            assert int(update) == received[topic], "out of order on %s" % topic
+            received[topic] += 1
+        log_sub.info("%r received %s", prefix, dict((topic, n) for topic, n in received.items() if n))
+        sub.close()
+
+    threads = [threading.Thread(target=subscriber, args=(prefix,)) for prefix in ("C", "")]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)  # slow joiner: the shards learn the subscriptions asynchronously
+
+    for i in range(N_UPDATES):
+        for topic in topics:
+            publisher.publish(topic, str(i))
+    for thread in threads:
+        thread.join()
+    publisher.close()
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import logging
+import struct
+import time
+import zmq
+
+from topic_index import TopicPublisher
+
+
+log_pub = logging.getLogger(name="PUBLISHER")
+log_sub = logging.getLogger(name="SUBSCRIBER")
+
+SNAPSHOT = b"SNAPSHOT"
+SEQ = struct.Struct("!Q")
+
+
+class StatePublisher(object):
+    """
+    Publisher side of the snapshot + sequence protocol, which lets subscribers join at any time.
+
+    Every topic has its own sequence number and the publisher keeps the last (seq, value) of each topic. Deltas go
+    out over PUB as [topic, seq, value]. A joining (or lagging) subscriber asks the snapshot ROUTER for
+    [SNAPSHOT, prefix] and gets one [topic, seq, value] per matching topic followed by a one-frame [END] marker.
+    The publisher never waits for subscribers; serve_snapshots() must just be called regularly from the publishing
+    thread, it also applies new subscriptions. Endpoints left out are bound by the caller (`publisher.socket`,
+    `snapshots`).
+
+    A snapshot larger than the HWM of the snapshot pipe isn't dropped: the ROUTER is ROUTER_MANDATORY, so a full pipe
+    means EAGAIN and the publisher waits for the subscriber to make room, up to send_timeout ms per message. A
+    snapshot that can't be delivered (timeout, subscriber gone) is abandoned and the subscriber times out.
+    """
+
+    END = b"END"
+
+    def __init__(self, context, endpoint=None, snapshot_endpoint=None, send_timeout=5000):
+        self.publisher = TopicPublisher(context, endpoint)
+        self.send_timeout = send_timeout
+        self.snapshots = context.socket(zmq.ROUTER)
+        self.snapshots.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        if snapshot_endpoint:
+            self.snapshots.bind(snapshot_endpoint)
+        self.state = {}  # topic -> (seq, value)
+        self._poller = zmq.Poller()
+        self._poller.register(self.snapshots, zmq.POLLIN)
+        self._poller.register(self.publisher.socket, zmq.POLLIN)
+
+    def publish(self, topic, value):
+        seq = self.state[topic][0] + 1 if topic in self.state else 1
+        self.state[topic] = (seq, value)
+        return self.publisher.publish(topic, [SEQ.pack(seq), value])
+
+    def serve_snapshots(self, timeout=0):
+        """Apply new subscriptions and answer the pending snapshot requests, waiting up to timeout ms for either"""
+        events = dict(self._poller.poll(timeout))
+        if self.publisher.socket in events:
+            self.publisher.process_subscriptions()
+        if self.snapshots not in events:
+            return
+        while self.snapshots.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            frames = self.snapshots.recv_multipart()
+            if len(frames) != 3 or frames[1] != SNAPSHOT:
+                log_pub.warning("Ignored a malformed snapshot request of %d frames", len(frames))
+                continue
+            identity, request, prefix = frames
+            sent = 0
+            try:
+                for topic, (seq, value) in self.state.items():
+                    if topic.startswith(prefix):
+                        self._send_snapshot([identity, topic, SEQ.pack(seq), value])
+                        sent += 1
+                self._send_snapshot([identity, self.END])
+            except zmq.ZMQError as e:
+                if e.errno not in (zmq.EAGAIN, zmq.EHOSTUNREACH):
+                    raise
+                log_pub.warning("Abandoned the snapshot for %r after %d topics: %s", prefix, sent, e)
+                continue
+            log_pub.info("Sent snapshot of %d topics for %r", sent, prefix)
+
+    def _send_snapshot(self, frames):
+        """Send one snapshot message, waiting up to send_timeout ms while the subscriber's pipe is full"""
+        deadline = time.time() + self.send_timeout / 1000.0
+        while True:
+            try:
+                self.snapshots.send_multipart(frames, zmq.NOBLOCK)
+                return
+            except zmq.Again:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise
+                self.snapshots.poll(min(remaining * 1000, 10), zmq.POLLOUT)
+
+    def close(self):
+        self.publisher.close()
+        self.snapshots.close()
+
+
+class StateSubscriber(object):
+    """
+    Subscriber side: subscribe first (deltas queue up in the SUB socket), then load the snapshot and drop the queued
+    deltas it already covers. A delta whose seq skips ahead of the last one seen for its topic means messages were
+    lost (HWM, reconnect), so the topic is caught up from a fresh snapshot instead of going silently out of sync.
+    A lost delta is only noticed with the next delta of its topic, an idle subscriber costs the publisher nothing.
+    A snapshot not answered within snapshot_timeout ms raises zmq.Again.
+    """
+
+    def __init__(self, context, endpoint, snapshot_endpoint, prefix, snapshot_timeout=5000):
+        self.prefix = prefix
+        self.snapshot_timeout = snapshot_timeout
+        self.subscriber = context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, prefix)
+        self.subscriber.connect(endpoint)
+        self.snapshots = context.socket(zmq.DEALER)
+        self.snapshots.setsockopt(zmq.LINGER, 0)
+        self.snapshots.connect(snapshot_endpoint)
+        self.state = {}  # topic -> (seq, value)
+        try:
+            self._pending = self._snapshot(prefix)
+        except zmq.Again:
+            self.close()
+            raise
+
+    def _snapshot(self, prefix):
+        self.snapshots.send_multipart([SNAPSHOT, prefix])
+        updates = []
+        while True:
+            if not self.snapshots.poll(self.snapshot_timeout):
+                raise zmq.Again("no snapshot for %r within %d ms" % (prefix, self.snapshot_timeout))
+            frames = self.snapshots.recv_multipart()
+            if len(frames) == 1:  # END
+                return updates
+            topic, seq, value = frames[0], SEQ.unpack(frames[1])[0], frames[2]
+            if seq > self.state.get(topic, (0, None))[0]:
+                self.state[topic] = (seq, value)
+                updates.append((topic, seq, value))
+
+    def recv(self):
+        """Return the next (topic, seq, value) update, snapshot entries first"""
+        while True:
+            if self._pending:
+                return self._pending.pop(0)
+            topic, seq, value = self.subscriber.recv_multipart()
+            seq = SEQ.unpack(seq)[0]
+            last_seq = self.state.get(topic, (0, None))[0]
+            if seq <= last_seq:
+                continue  # already covered by a snapshot
+            if seq > last_seq + 1:
+                log_sub.info("Gap on %r: expected %d, got %d - catching up", topic, last_seq + 1, seq)
+                self._pending = self._snapshot(topic)
+                continue
+            self.state[topic] = (seq, value)
+            return topic, seq, value
+
+    def close(self):
+        self.subscriber.close()
+        self.snapshots.close()
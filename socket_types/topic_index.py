@@ -0,0 +1,156 @@
+import collections
+import logging
+import zmq
+
+
+log_pub = logging.getLogger(name="PUBLISHER")
+
+
+class _Node(object):
+    __slots__ = ("children", "count")
+
+    def __init__(self):
+        self.children = {}
+        self.count = 0  # subscriptions for exactly this prefix
+
+
+class SubscriptionTrie(object):
+    """
+    Prefix trie of live subscriptions, the same prefix matching libzmq does on the subscriber side.
+
+    matches(topic) walks at most len(topic) nodes no matter how many subscriptions exist. Results are cached per topic
+    until the subscriptions change, so a hot topic costs a couple of dict operations; only the cache_size most
+    recently published topics are kept, topics that come and go don't pile up.
+    """
+
+    def __init__(self, cache_size=10000):
+        self._root = _Node()
+        self._cache = collections.OrderedDict()  # topic -> matches, least recently used first
+        self.cache_size = cache_size
+
+    def _path(self, prefix, create=False):
+        nodes = [self._root]
+        node = self._root
+        for char in prefix:
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[char] = _Node()
+            nodes.append(child)
+            node = child
+        return nodes
+
+    def subscribe(self, prefix):
+        self._path(prefix, create=True)[-1].count += 1
+        self._cache.clear()
+
+    def unsubscribe(self, prefix, all_subscribers=False):
+        nodes = self._path(prefix)
+        if nodes is None or not nodes[-1].count:
+            return
+        nodes[-1].count = 0 if all_subscribers else nodes[-1].count - 1
+        # prune the branch that no longer leads to any subscription
+        for char, parent, node in reversed(list(zip(prefix, nodes, nodes[1:]))):
+            if node.count or node.children:
+                break
+            del parent.children[char]
+        self._cache.clear()
+
+    def matches(self, topic):
+        """Tell if any subscription is a prefix of topic"""
+        try:
+            found = self._cache.pop(topic)
+        except KeyError:
+            node = self._root
+            found = node.count > 0
+            for char in topic:
+                if found:
+                    break
+                node = node.children.get(char)
+                if node is None:
+                    break
+                found = node.count > 0
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[topic] = found  # (re)inserted as the most recently used
+        return found
+
+    def subscribers(self, prefix):
+        """Number of subscriptions for exactly this prefix"""
+        nodes = self._path(prefix)
+        return nodes[-1].count if nodes else 0
+
+    def subscribers_under(self, prefix):
+        """Number of subscriptions for this prefix and every longer prefix starting with it"""
+        nodes = self._path(prefix)
+        if not nodes:
+            return 0
+        total = 0
+        stack = [nodes[-1]]
+        while stack:
+            node = stack.pop()
+            total += node.count
+            stack.extend(node.children.values())
+        return total
+
+
+class TopicPublisher(object):
+    """
+    XPUB publisher that only sends topics somebody subscribed to.
+
+    XPUB hands us the subscribe (first byte 1) and unsubscribe (first byte 0) messages of the subscribers, which feed
+    a SubscriptionTrie. publish() checks the trie first, so a message for a cold topic is neither serialised (the
+    payload may be a callable) nor sent. With XPUB_VERBOSE every subscriber's subscription is counted, but before
+    XPUB_VERBOSER (libzmq 4.2) the unsubscribe only comes when the last subscriber of a prefix leaves, so in that case
+    it clears the whole prefix.
+
+    publish() doesn't look for new subscriptions itself: register `socket` with the poller of the publishing loop and
+    call process_subscriptions() when it is readable. Without an endpoint the caller binds `socket` itself.
+    """
+
+    def __init__(self, context, endpoint=None):
+        self.socket = context.socket(zmq.XPUB)
+        self._exact_unsubscribe = hasattr(zmq, "XPUB_VERBOSER")
+        self.socket.setsockopt(zmq.XPUB_VERBOSER if self._exact_unsubscribe else zmq.XPUB_VERBOSE, 1)
+        if endpoint:
+            self.socket.bind(endpoint)
+        self.subscriptions = SubscriptionTrie()
+        self.sent = 0
+        self.skipped = 0
+
+    def process_subscriptions(self):
+        """Apply all pending (un)subscriptions, never blocks; call it when a poller reports the socket readable"""
+        while self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            msg = self.socket.recv()
+            if not msg:
+                continue
+            subscribe, prefix = msg[0] == b"\x01", msg[1:]
+            if subscribe:
+                self.subscriptions.subscribe(prefix)
+            else:
+                self.subscriptions.unsubscribe(prefix, all_subscribers=not self._exact_unsubscribe)
+            log_pub.debug("%s: %r", "Subscribed" if subscribe else "Unsubscribed", prefix)
+
+    def publish(self, topic, payload=None):
+        """
+        Send [topic] + payload if anybody listens to topic. payload is a list of frames, a single frame or a callable
+        returning either, called only when the message is really sent. Returns whether the message was sent.
+        """
+        if not self.subscriptions.matches(topic):
+            self.skipped += 1
+            return False
+        if callable(payload):
+            payload = payload()
+        if payload is None:
+            frames = [topic]
+        elif isinstance(payload, list):
+            frames = [topic] + payload
+        else:
+            frames = [topic, payload]
+        self.socket.send_multipart(frames)
+        self.sent += 1
+        return True
+
+    def close(self):
+        self.socket.close()
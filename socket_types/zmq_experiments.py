@@ -1,6 +1,11 @@
 import time
 import zmq
 
+from credit_flow import CreditReceiver, CreditSender
+from router_registry import RouterRegistry
+from socket_features.hwm_controller import HWMController
+from socket_features.telemetry import InstrumentedSocket
+
 
 def cleanup(sockets, context):
     for socket in sockets:
@@ -11,8 +16,9 @@ def cleanup(sockets, context):
 def rep_multiple_reqs():
     context = zmq.Context.instance()
     requesters = []
-    server = context.socket(zmq.REP)
+    server = InstrumentedSocket(context.socket(zmq.REP), "server")
     server.set_hwm(2) # set to 1 and server discards messages
+    controller = HWMController(server, min_hwm=2)  # where to go from the fixed 2, never down to the discarding 1
     nr_requesters = 3
     port = 5005
     endpoint = "tcp://127.0.0.1:%s" % port
@@ -46,6 +52,8 @@ def rep_multiple_reqs():
         except zmq.ZMQError as zmqe:
             print "requester %d invalid state" % (requester_id, zmqe)
 
+    controller.update()
+    print "controller would run the server with HWM %d" % controller.hwm
     cleanup(requesters + [server], context)
 
 
@@ -88,9 +96,10 @@ def req_multiple_rep():
 def dealer_rep():
     context = zmq.Context.instance()
     servers = []
-    dealer = context.socket(zmq.DEALER)
+    dealer = InstrumentedSocket(context.socket(zmq.DEALER), "dealer")
     #dealer.setsockopt(zmq.IDENTITY, b"smooth-dealer:")
     dealer.set_hwm(1) # note that it doesn't block
+    controller = HWMController(dealer)  # retunes the HWM between the rounds
     ports = range(6005, 6008)
     for port in ports:
         endpoint = "tcp://127.0.0.1:%s" % port
@@ -114,15 +123,64 @@ def dealer_rep():
                 print "server at %d got %s" % (server_id, eagain)
             except zmq.ZMQError as zmqe:
                 print "server at %d already received a message" % server_id
+        if controller.update():  # reconnects the dealer, what the servers didn't read yet is dropped
+            print "dealer HWM now %d" % controller.hwm
 
     cleanup(servers + [dealer], context)
 
 
+def dealer_credit_fanout():
+    # like dealer_rep but paced by credit instead of set_hwm(1) and sleeps: every server grants a window of
+    # messages and the sender only sends what it was granted
+    context = zmq.Context.instance()
+    servers = []
+    sender = context.socket(zmq.ROUTER)  # a ROUTER keeps the credit per server, a DEALER would pool it
+    ports = range(6005, 6008)
+    for port in ports:
+        endpoint = "tcp://127.0.0.1:%s" % port
+        server = context.socket(zmq.DEALER)
+        server.setsockopt(zmq.IDENTITY, str(port))
+        server.bind(endpoint)
+        servers.append(server)
+        sender.connect(endpoint)
+    receivers = dict((server, CreditReceiver(server, window=4)) for server in servers)  # grants block until connected
+    credit_sender = CreditSender(sender)
+
+    poller = zmq.Poller()
+    for server in servers:
+        poller.register(server, zmq.POLLIN)
+    poller.register(sender, zmq.POLLIN)  # credit coming back
+
+    total = 30
+    sent = received = 0
+    while received < total:
+        while sent < total:
+            try:
+                server_id = credit_sender.send([str(sent)], timeout=0)
+                print 'sender sends %d to %s' % (sent, server_id)
+                sent += 1
+            except zmq.Again:
+                break  # out of credit
+        for server, _ in poller.poll():  # wait for messages or credit in flight instead of sleeping
+            if server is sender:
+                credit_sender.process_credit()  # also once everything is sent, or the poll would spin on it
+                continue
+            while server.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                reply = receivers[server].recv(zmq.NOBLOCK)
+                print "%s: %s" % (server.getsockopt(zmq.IDENTITY), reply[0])
+                received += 1
+
+    cleanup(servers + [sender], context)
+
+
 def router_receive_from_multiple_dealers():
-    # for some reason not all messages are delivered...
+    # not all messages were delivered before: recv() returned a single frame of the 3-frame messages and the loop
+    # stopped at the first zmq.Again while messages were still in flight. Now whole messages are received until all
+    # of them arrived, no sleeps needed
     context = zmq.Context.instance()
     dealers = []
     router = context.socket(zmq.ROUTER)
+    registry = RouterRegistry(router)
     dealer_ids = range(5005, 5008)
     router.bind("tcp://127.0.0.1:%d" % dealer_ids[0])
     for dealer_id in dealer_ids:
@@ -131,34 +189,39 @@ def router_receive_from_multiple_dealers():
         dealer.connect("tcp://127.0.0.1:%d" % dealer_ids[0])
         dealers.append(dealer)
 
-    # each dealer sends one message
+    # each dealer sends two messages, they wait in the dealer until the connection is up
     msgs_sent = 0
     for dealer in dealers:
         for inc in range(0, 20, 10):
             dealer_id = int(dealer.getsockopt(zmq.IDENTITY))
             print 'dealer sends: %s' % ([str(dealer_id), str(dealer_id + inc)])
-            dealer.send_multipart([dealer.getsockopt(zmq.IDENTITY), str(dealer_id + inc)])  # must send the receiver id first
-            #print 'dealer sends: %s' % str(dealer_id + inc)
-            #dealer.send(str(dealer_id + inc))  # must send the receiver id first
+            dealer.send_multipart([dealer.getsockopt(zmq.IDENTITY), str(dealer_id + inc)])
             msgs_sent += 1
-        time.sleep(0.05)
 
-    while True:
-        try:
-            reply = router.recv(zmq.NOBLOCK)
-            print 'router received: %s' % reply
-        except zmq.Again as eagain:
+    msgs_received = 0
+    while msgs_received < msgs_sent:
+        if not registry.poll(1000):
+            print 'router timed out with %d of %d messages' % (msgs_received, msgs_sent)
             break
+        try:
+            reply = registry.recv(zmq.NOBLOCK)
+        except zmq.Again:
+            continue  # it was a connect notification
+        print 'router received: %s' % reply
+        msgs_received += 1
 
-    cleanup(dealers +[router], context)
+    registry.close()
+    cleanup(dealers + [router], context)
 
 
 def router_send_to_multiple_dealers():
-    # for some reason not all messages are delivered...
+    # not all messages were delivered before: the router sent to identities which hadn't connected yet and a ROUTER
+    # drops those silently. The registry queues them per identity and flushes them when the dealer connects
     context = zmq.Context.instance()
     dealers = []
     router = context.socket(zmq.ROUTER)
-    dealer_ids = range(5005, 5006)
+    registry = RouterRegistry(router)
+    dealer_ids = range(5005, 5008)
     router.bind("tcp://127.0.0.1:%d" % dealer_ids[0])
     for dealer_id in dealer_ids:
         dealer = context.socket(zmq.DEALER)
@@ -166,41 +229,32 @@ def router_send_to_multiple_dealers():
         dealer.connect("tcp://127.0.0.1:%d" % dealer_ids[0])
         dealers.append(dealer)
 
-    # router sends 6 messages
+    END_MSG = "%END%"
+    # router sends 3 messages and an end message to every dealer, right away
     for dealer_id in dealer_ids:
         for inc in range(0, 30, 10):
             print 'router sends: %s' % (dealer_id + inc,)
-            router.send_multipart([str(dealer_id), str(dealer_id + inc)])  # must send the receiver id first
-        time.sleep(0.05)
-        for dealer_id, dealer in zip(dealer_ids, dealers):
-            try:
-                reply = dealer.recv(zmq.NOBLOCK)  # the dealer only receives the payload
-                print "dealer at %d got: %s" % (dealer_id, reply)
-            except zmq.Again as eagain:
-                print "error: dealer %d: %s" % (dealer_id, eagain)
-
-    END_MSG = "%END%"
-    # router sends final messages
-    for dealer_id in dealer_ids:
+            registry.send(str(dealer_id), [str(dealer_id + inc)])  # queued if the dealer isn't connected yet
         print 'router sends end message to %s' % (dealer_id,)
-        router.send_multipart([str(dealer_id), END_MSG])
+        registry.send(str(dealer_id), [END_MSG])
+    if not registry.wait_flushed(timeout=5000):
+        print 'error: still queued for %s' % registry.queued.keys()
 
-    # get remaining messages
+    # get all messages
     for dealer, dealer_id in zip(dealers, dealer_ids):
         while True:
-            try:
-                reply = dealer.recv(zmq.NOBLOCK)  # the dealer only receives the payload
-                print "dealer at %d got: %s" % (dealer_id, reply)
-                if reply == END_MSG:
-                    break
-            except zmq.Again as eagain:
-                print "error: dealer %d: %s" % (dealer_id, eagain)
+            reply = dealer.recv()  # the dealer only receives the payload
+            print "dealer at %d got: %s" % (dealer_id, reply)
+            if reply == END_MSG:
+                break
 
+    registry.close()
     cleanup(dealers + [router], context)
 
 
 rep_multiple_reqs()
 #req_multiple_rep()
 #dealer_rep()
+#dealer_credit_fanout()
 #router_receive_from_multiple_dealers()
 #router_send_to_multiple_dealers()
\ No newline at end of file
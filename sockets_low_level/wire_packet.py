@@ -1,3 +1,4 @@
+import binascii
 import logging
 import socket
 import struct
@@ -11,21 +12,226 @@ log_receiver = logging.getLogger(name="RECEIVER")
 log_sender = logging.getLogger(name="SENDER")
 
 
-def _get_signature(sock):
-    msg = sock.recv(10)
-    assert len(msg) == 10
-    log_receiver.info("Got signature: %s", msg.encode('hex'))
+class FrameDecoder(object):
+    """
+    Incremental ZMTP decoder on top of a connected stream socket.
+
+    Data is pulled with recv_into() in large chunks into one reusable bytearray, so a single syscall usually covers
+    many frames and short reads are simply continued. Frames and greeting fields are handed out as memoryview slices
+    of that buffer without copying. A slice stays valid until the next message (or greeting field) is read - call
+    tobytes() on it to keep the data longer.
+    """
+
+    def __init__(self, sock, buffer_size=64 * 1024):
+        self._sock = sock
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first byte not consumed yet
+        self._end = 0  # one past the last byte received
+        self._msg_start = 0  # first byte of the message being decoded, must not move while it is handed out
+
+    def _make_room(self, n):
+        pending = self._end - self._start
+        if self._msg_start == self._start and len(self._buf) >= n:
+            # nothing of the current message was handed out yet, so the partial tail can be moved to the front
+            self._buf[:pending] = self._view[self._start:self._end].tobytes()
+        else:
+            # slices of the current message point into the old buffer, leave it untouched and switch to a new one
+            buf = bytearray(max(len(self._buf), n))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = self._msg_start = 0
+        self._end = pending
+
+    def _fill(self, n):
+        while self._end - self._start < n:
+            if len(self._buf) - self._start < n:
+                self._make_room(n)
+            received = self._sock.recv_into(self._view[self._end:])
+            if not received:
+                raise EOFError("peer closed the connection")
+            self._end += received
+
+    def _take(self, n):
+        self._fill(n)
+        chunk = self._view[self._start:self._start + n]
+        self._start += n
+        return chunk
+
+    def read(self, n):
+        """Read exactly n raw bytes (used for the greeting fields)"""
+        self._msg_start = self._start
+        return self._take(n)
+
+    def read_frame(self):
+        """Read one frame and return (has_more_frames, payload)"""
+        self._fill(2)
+        flag, = struct.unpack_from("!B", self._buf, self._start)
+        if flag & 0x02:
+            self._fill(9)
+            msg_len, = struct.unpack_from("!Q", self._buf, self._start + 1)
+            self._start += 9
+        else:
+            msg_len, = struct.unpack_from("!B", self._buf, self._start + 1)
+            self._start += 2
+        return flag & 0x01, self._take(msg_len)
+
+    def read_message(self):
+        """Read all frames of the next message"""
+        self._msg_start = self._start
+        frames = []
+        has_more_frames = True
+        while has_more_frames:
+            has_more_frames, payload = self.read_frame()
+            frames.append(payload)
+        return frames
+
+    def __iter__(self):
+        while True:
+            yield self.read_message()
+
+    # Non-blocking use: an event loop calls receive() once per readable event and then takes the complete messages
+    # with next_message(). Nothing in here ever waits for the socket.
+
+    @property
+    def buffered(self):
+        """Number of received bytes not consumed yet"""
+        return self._end - self._start
+
+    def receive(self):
+        """Do a single recv_into() and return the number of bytes read (0 means the peer closed the connection)"""
+        if self._end == len(self._buf):
+            self._make_room(2 * len(self._buf) if self._start == 0 else len(self._buf))
+        received = self._sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def message_ready(self, offset=0):
+        """Tell if a whole message starting offset bytes into the unread data has been received"""
+        pos = self._start + offset
+        has_more_frames = True
+        while has_more_frames:
+            if self._end - pos < 2:
+                return False
+            flag, = struct.unpack_from("!B", self._buf, pos)
+            if flag & 0x02:
+                if self._end - pos < 9:
+                    return False
+                msg_len, = struct.unpack_from("!Q", self._buf, pos + 1)
+                pos += 9 + msg_len
+            else:
+                msg_len, = struct.unpack_from("!B", self._buf, pos + 1)
+                pos += 2 + msg_len
+            if pos > self._end:
+                return False
+            has_more_frames = flag & 0x01
+        return True
+
+    def next_message(self):
+        """Return the next message if it was fully received, otherwise None"""
+        if self.message_ready():
+            return self.read_message()
+
+
+def _frame_buffers(frames, headers, header_view=None):
+    """
+    A multipart message as a list of buffers in wire order. The flag and length headers are packed into `headers`
+    (at least 9 bytes per frame) and returned as slices of it, payloads are passed through as they are.
+    """
+    header_view = memoryview(headers) if header_view is None else header_view
+    buffers = []
+    offset = 0
+    last = len(frames) - 1
+    for i, payload in enumerate(frames):
+        flag = 0x01 if i < last else 0x00
+        msg_len = len(payload)
+        if msg_len > 255:
+            struct.pack_into("!BQ", headers, offset, flag | 0x02, msg_len)
+            header_len = 9
+        else:
+            struct.pack_into("!BB", headers, offset, flag, msg_len)
+            header_len = 2
+        buffers.append(header_view[offset:offset + header_len])
+        if msg_len:
+            buffers.append(payload)
+        offset += header_len
+    return buffers
+
+
+class FrameEncoder(object):
+    """
+    ZMTP encoder for whole multipart messages.
+
+    The flag and length headers are packed into a preallocated bytearray and the message goes out as one list of
+    buffers: headers are slices of that bytearray, payloads are passed through as they are. Where the socket has
+    sendmsg() the whole message is a single scatter-gather call. Without it (Python 2) headers and small payloads are
+    coalesced into one write and every large payload is sent straight from its own buffer, so nothing big is copied.
+    """
+
+    IOV_MAX = 1024  # Linux limit of buffers per sendmsg() call
+    COPY_THRESHOLD = 4096  # without sendmsg() payloads up to this size are merged with the headers
+
+    def __init__(self, sock, max_frames=16):
+        self._sock = sock
+        self._headers = bytearray(9 * max_frames)
+        self._header_view = memoryview(self._headers)
+
+    def _buffers(self, frames):
+        if len(self._headers) < 9 * len(frames):
+            self._headers = bytearray(9 * len(frames))
+            self._header_view = memoryview(self._headers)
+        return _frame_buffers(frames, self._headers, self._header_view)
+
+    def _sendmsg_all(self, buffers):
+        buffers = [memoryview(buf) for buf in buffers]
+        first = 0
+        while first < len(buffers):
+            sent = self._sock.sendmsg(buffers[first:first + self.IOV_MAX])
+            while sent:  # skip what went out, a short write may stop in the middle of a buffer
+                buf_len = len(buffers[first])
+                if sent >= buf_len:
+                    sent -= buf_len
+                    first += 1
+                else:
+                    buffers[first] = buffers[first][sent:]
+                    sent = 0
+
+    def _sendall_coalesced(self, buffers):
+        pending = bytearray()
+        for buf in buffers:
+            if len(buf) <= self.COPY_THRESHOLD:
+                pending += buf
+                continue
+            if pending:
+                self._sock.sendall(pending)
+                pending = bytearray()
+            self._sock.sendall(buf)
+        if pending:
+            self._sock.sendall(pending)
+
+    def send(self, frames):
+        """Send a multipart message, all frames but the last one carry the MORE flag"""
+        buffers = self._buffers(frames)
+        if hasattr(self._sock, "sendmsg"):
+            self._sendmsg_all(buffers)
+        else:
+            self._sendall_coalesced(buffers)
+
+
+def _get_signature(decoder):
+    msg = decoder.read(10)
+    log_receiver.info("Got signature: %s", binascii.hexlify(msg))  # once per connection, not worth deferring
     return msg
 
 
-def _get_revision(sock):
-    msg = sock.recv(1)
-    assert len(msg) == 1
-    log_receiver.info("Got revision: %s", msg.encode('hex'))
+def _get_revision(decoder):
+    msg = decoder.read(1)
+    log_receiver.info("Got revision: %s", binascii.hexlify(msg))
     return msg
 
 
-def _get_sock_type(sock):
+def _get_sock_type(decoder):
     sock_type = {
         0: "PAIR",
         1: "PUB",
@@ -37,72 +243,43 @@ def _get_sock_type(sock):
         7: "PULL",
         8: "PUSH"
     }
-    msg = sock.recv(1)
-    assert len(msg) == 1
-    log_receiver.info("Got socket type: %s", sock_type[ord(msg)])
-
-
-def _get_identity(sock):
-    msg = sock.recv(2)
-    assert len(msg) == 2
-    id_len = int(msg[1].encode('hex'), 16)
-    if id_len > 0:
-        prefix = msg
-        msg = sock.recv(id_len)
-        assert len(msg) == id_len
-        log_receiver.info("Got identity: %s", (prefix + msg).encode('hex'))
-        return msg
-    log_receiver.info("Got identity: %s", msg.encode('hex'))
-
-
-def _get_message(sock):
-    msgs = []
-    has_more_frames = True
-    while has_more_frames:
-        flag_byte = sock.recv(1)
-        assert len(flag_byte) == 1
-        flag = struct.unpack('!b', flag_byte)[0]
-        has_more_frames = flag & 0x01
-        len_field = 8 if flag & 0x02 else 1
-        msg_len_bytes = sock.recv(len_field)
-        assert len(msg_len_bytes) == len_field
-        if len_field == 8:
-            msg_len = struct.unpack("!Q", msg_len_bytes)[0]
-        else:
-            msg_len = struct.unpack("!B", msg_len_bytes)[0]
-        payload = ""
-        if msg_len:
-            payload = sock.recv(msg_len)
-            assert len(payload) == msg_len
-            msgs.append(payload)
-        msg = flag_byte+msg_len_bytes+payload
-        log_receiver.info("Got message: %s (%s)", payload, msg.encode('hex'))
+    msg = decoder.read(1)
+    log_receiver.info("Got socket type: %s", sock_type[struct.unpack("!B", msg)[0]])
+
+
+def _get_identity(decoder):
+    _, identity = decoder.read_frame()  # the identity is sent as a regular (possibly empty) frame
+    log_receiver.info("Got identity: %s", binascii.hexlify(identity))
+    if len(identity) > 0:
+        return identity
+
+
+def _get_message(decoder):
+    msgs = [payload for payload in decoder.read_message() if len(payload)]  # skip the empty delimiter frames
+    if log_receiver.isEnabledFor(logging.INFO):  # don't copy the payloads just to throw the log record away
+        log_receiver.info("Got message: %.200s", [payload.tobytes() for payload in msgs])
     return msgs[0] if len(msgs) == 1 else msgs
 
 
-def _send_signature(sock):
+def _build_greeting(socket_type=zmq.REP, identity="Eugen"):
     signature = 'ff00000000000000017f'
     revision = '01'
-    socket_type = zmq.REP
-    identity = '0005457567656e'
-    msg = struct.pack("!10ssB%ds" % len(identity.decode('hex')), signature.decode('hex'), revision.decode('hex'), socket_type,
-                      identity.decode('hex'))
+    return struct.pack("!10ssBBB%ds" % len(identity), signature.decode('hex'), revision.decode('hex'), socket_type,
+                       0, len(identity), identity)
+
+
+def _send_signature(sock):
+    msg = _build_greeting()
     sock.sendall(msg)
-    log_receiver.info("Sent: %s", msg.encode('hex'))
+    log_receiver.info("Sent: %s", binascii.hexlify(msg))
 
 
-def _send_message(sock, msg, receiver_sock_type):
+def _send_message(encoder, msg, receiver_sock_type):
+    frames = msg if isinstance(msg, list) else [msg]
     if receiver_sock_type in [zmq.REQ]:  # some socket types do not understand identities but require an empty frame
-        preamble = '0100'.decode('hex')
-        sock.sendall(preamble)
-        log_receiver.info("Sent: %s", preamble.encode('hex'))
-    if len(msg) <= 255:
-        msg = ("00%02x" % len(msg)).decode("hex") + msg
-        sock.sendall(msg)
-    else:
-        msg = struct.pack("!cQs", 0, len(msg), msg)
-        sock.sendall(msg)
-    log_receiver.info("Sent: %s", msg.encode('hex'))
+        frames = [""] + frames
+    encoder.send(frames)
+    log_receiver.info("Sent: %.200s", frames)  # long payloads are cut
 
 
 def receive_in_loop(ip, port, receiver_sock_type):
@@ -115,22 +292,25 @@ def receive_in_loop(ip, port, receiver_sock_type):
         client_sock, addr = sock.accept()
         log_receiver.info("---GREETING STAGE---")
 
-        sender_sig = _get_signature(client_sock)
+        decoder = FrameDecoder(client_sock)
+        encoder = FrameEncoder(client_sock)
+
+        sender_sig = _get_signature(decoder)
 
         _send_signature(client_sock)
 
-        _get_revision(client_sock)
+        _get_revision(decoder)
 
-        _get_sock_type(client_sock)
+        _get_sock_type(decoder)
 
-        sender_id = _get_identity(client_sock)
+        sender_id = _get_identity(decoder)
 
         if receiver_sock_type != zmq.ROUTER:
-            msg = _get_message(client_sock)
-            _send_message(client_sock, "ack", receiver_sock_type)
+            msg = _get_message(decoder)
+            _send_message(encoder, "ack", receiver_sock_type)
         else:
-            _send_message(client_sock, "hello", receiver_sock_type)
-            msg = _get_message(client_sock)
+            _send_message(encoder, "hello", receiver_sock_type)
+            msg = _get_message(decoder)
         client_sock.close()
     except Exception:
         log_receiver.warn("exception", exc_info=True)
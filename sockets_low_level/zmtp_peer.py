@@ -0,0 +1,233 @@
+import asyncore
+import collections
+import itertools
+import logging
+import socket
+import struct
+import threading
+import zmq
+
+from wire_packet import FrameDecoder, _build_greeting, _frame_buffers
+
+
+log_peer = logging.getLogger(name="PEER")
+log_sender = logging.getLogger(name="SENDER")
+
+
+def _encode(frames):
+    # the framing of FrameEncoder, but the headers get their own bytearray: they wait in the queue after we return
+    return _frame_buffers(frames, bytearray(9 * len(frames)))
+
+
+class ZMTPConnection(asyncore.dispatcher):
+    """
+    One raw ZMTP/2.0 peer driven by the asyncore loop.
+
+    The greeting and framing are the same as in wire_packet.receive_in_loop() but nothing blocks: incoming bytes are
+    decoded with the non-blocking side of FrameDecoder and outgoing frames wait in a queue until the socket is
+    writable. Like _send_message() the empty delimiter of REQ peers is stripped on receive and added on send.
+
+    Backpressure: while more than high_water bytes are queued for the peer we stop reading from it, so a peer that
+    doesn't read its replies cannot make us buffer without limit.
+    """
+
+    def __init__(self, sock=None, socket_type=zmq.REP, identity="Eugen", on_ready=None, on_message=None,
+                 on_close=None, high_water=1024 * 1024, map=None):
+        asyncore.dispatcher.__init__(self, sock, map=map)
+        self.socket_type = socket_type
+        self.identity = identity
+        self.peer_type = None
+        self.peer_identity = None
+        self.ready = False  # greeting done
+        self._on_ready = on_ready
+        self._on_message = on_message
+        self._on_close = on_close
+        self._high_water = high_water
+        self._out = collections.deque()
+        self._out_bytes = 0
+        self._decoder = FrameDecoder(self.socket) if sock is not None else None
+        self._queue([_build_greeting(socket_type, identity)])
+
+    @property
+    def can_send(self):
+        return self._out_bytes < self._high_water
+
+    def send_message(self, frames):
+        """Queue a multipart message for the peer, returns False once the peer is over its high water mark"""
+        if self.peer_type == zmq.REQ:
+            frames = [""] + frames
+        self._queue(_encode(frames))
+        return self.can_send
+
+    def _queue(self, buffers):
+        for buf in buffers:
+            self._out.append(memoryview(buf))
+            self._out_bytes += len(buf)
+
+    def _read_greeting(self):
+        # signature (10) + revision (1) + socket type (1), then the identity as a regular frame
+        if self._decoder.buffered < 12 or not self._decoder.message_ready(12):
+            return False
+        signature = self._decoder.read(10)
+        if signature[0:1].tobytes() != "\xff" or not struct.unpack("!B", signature[9:10])[0] & 0x01:
+            raise ValueError("not a ZMTP/2.0 peer")
+        self._decoder.read(1)  # revision
+        self.peer_type = struct.unpack("!B", self._decoder.read(1))[0]
+        self.peer_identity = self._decoder.read_message()[0].tobytes()
+        self.ready = True
+        log_peer.debug("Greeting done, peer type %d, identity %r", self.peer_type, self.peer_identity)
+        if self._on_ready:
+            self._on_ready(self)
+        return True
+
+    def readable(self):
+        return self.can_send
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_read(self):
+        if not self._decoder.receive():
+            self.handle_close()
+            return
+        if not self.ready and not self._read_greeting():
+            return
+        while True:
+            frames = self._decoder.next_message()
+            if frames is None:
+                break
+            if self.peer_type == zmq.REQ and frames and not len(frames[0]):
+                frames = frames[1:]
+            if self._on_message:
+                self._on_message(self, frames)
+
+    def handle_write(self):
+        while self._out:
+            sent = self.send(self._out[0])
+            if not sent:  # asyncore returns 0 on EWOULDBLOCK
+                return
+            self._out_bytes -= sent
+            if sent < len(self._out[0]):
+                self._out[0] = self._out[0][sent:]
+                return
+            self._out.popleft()
+
+    def handle_close(self):
+        self.close()
+        if self._on_close:
+            self._on_close(self)
+
+    def handle_error(self):
+        log_peer.warn("exception", exc_info=True)
+        self.handle_close()
+
+
+class ZMTPClient(ZMTPConnection):
+    def __init__(self, ip, port, **kwargs):
+        ZMTPConnection.__init__(self, **kwargs)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._decoder = FrameDecoder(self.socket)
+        self.connect((ip, port))
+
+    def handle_connect(self):
+        pass
+
+
+class ZMTPServer(asyncore.dispatcher):
+    """
+    Listening side: accepts any number of ZMTP peers on one asyncore loop.
+
+    Peers are registered by identity once their greeting is done, so the server can address them the way a ROUTER
+    does (send_to). Peers without an identity get a generated one, like libzmq does.
+    """
+
+    def __init__(self, ip, port, socket_type=zmq.REP, identity="Eugen", on_ready=None, on_message=None,
+                 high_water=1024 * 1024, backlog=1024, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.peers = {}
+        self._peer_args = dict(socket_type=socket_type, identity=identity, on_message=on_message,
+                               high_water=high_water)
+        self._on_ready = on_ready
+        self._ids = itertools.count(1)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((ip, port))
+        self.listen(backlog)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        ZMTPConnection(sock, on_ready=self._register, on_close=self._unregister, map=self._map, **self._peer_args)
+
+    def _register(self, peer):
+        if not peer.peer_identity:
+            peer.peer_identity = struct.pack("!BI", 0, next(self._ids))
+        self.peers[peer.peer_identity] = peer
+        if self._on_ready:
+            self._on_ready(peer)
+
+    def _unregister(self, peer):
+        if self.peers.get(peer.peer_identity) is peer:
+            del self.peers[peer.peer_identity]
+
+    def send_to(self, identity, frames):
+        peer = self.peers.get(identity)
+        if peer is None:
+            return False
+        return peer.send_message(frames)
+
+    def close(self):
+        for peer in self.peers.values():
+            peer.close()
+        asyncore.dispatcher.close(self)
+
+
+def run_zmq_peers(context, endpoint, n_peers, sock_type):
+    """The zmq side of test_REQ/test_DEALER/test_ROUTER, but with many sockets at once"""
+    senders = []
+    for i in range(n_peers):
+        sender = context.socket(sock_type)
+        if sock_type == zmq.ROUTER:
+            sender.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        sender.connect(endpoint)
+        senders.append(sender)
+    for sender in senders:
+        if sock_type == zmq.ROUTER:
+            msg = sender.recv_multipart()  # our server talks first to ROUTER peers
+            sender.send_multipart([msg[0], "test"])
+        else:
+            sender.send("test")
+    if sock_type != zmq.ROUTER:
+        for sender in senders:
+            sender.recv()
+    log_sender.info("%d peers of type %d done", n_peers, sock_type)
+    for sender in senders:
+        sender.close(linger=1000)
+
+
+def main():
+    def on_ready(peer):
+        if peer.peer_type == zmq.ROUTER:
+            peer.send_message(["hello"])  # a ROUTER doesn't know our address until we say something
+
+    def on_message(peer, frames):
+        log_peer.debug("Got message from %r: %s", peer.peer_identity, [frame.tobytes() for frame in frames])
+        if peer.peer_type != zmq.ROUTER:
+            peer.send_message(["ack"])
+
+    server = ZMTPServer('127.0.0.1', 5555, on_ready=on_ready, on_message=on_message)
+    context = zmq.Context()
+    for sock_type in [zmq.REQ, zmq.DEALER, zmq.ROUTER]:
+        peers_thread = threading.Thread(target=run_zmq_peers,
+                                        args=(context, "tcp://127.0.0.1:5555", 500, sock_type))
+        peers_thread.start()
+        while peers_thread.is_alive():
+            asyncore.loop(timeout=0.1, use_poll=True, count=1)
+    server.close()
+    context.destroy(linger=1)
+
+
+if __name__ == "__main__":
+    main()